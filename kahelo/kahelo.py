@@ -8,18 +8,36 @@ import argparse
 import webbrowser
 import random
 import copy
+import collections
+import itertools
+import asyncio
+import threading
+import mmap
+import struct
+import array
+import bisect
+import heapq
+import base64
+import multiprocessing
 
 if sys.version_info < (3,):
     import ConfigParser as configparser
     import StringIO
+    import httplib as http_client
     from urllib2 import urlopen as urlopen, HTTPError
+    from urllib import getproxies, proxy_bypass, unquote
+    from urlparse import urlsplit, urljoin
     from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
 else:
     import configparser
     import io
-    from urllib.request import urlopen as urlopen
+    import http.client as http_client
+    from urllib.request import urlopen as urlopen, getproxies, proxy_bypass
     from urllib.error import HTTPError
+    from urllib.parse import urlsplit, urljoin, unquote
     from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
 
 try:
     import sqlite3
@@ -27,13 +45,20 @@ try:
 except:
     sqlite3_available = False
 
+try:
+    import numpy
+    numpy_available = True
+except:
+    numpy_available = False
+
 try:
     import xml.etree.cElementTree as ET
 except:
     import xml.etree.ElementTree as ET
 
 from PIL import Image, ImageDraw
-from time import time, sleep, strftime, gmtime
+from time import time, sleep, strftime, gmtime, monotonic
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 IDENTITY = """\
@@ -70,6 +95,8 @@ THE SOFTWARE.
 
 APPNAME = 'kahelo'
 MAXZOOM = 18
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+FOLDER_SCAN_THREADS = 8
 
 
 # -- Command line parsing ----------------------------------------------------
@@ -85,6 +112,7 @@ USAGE = """
   -count    <db name> <tileset>
   -stat     <db name> <tileset>
   -server   <db name>
+  -rebuild  <db name>
 
 tileset:
   -track <track_filename> -zoom <zoom_level> [-radius <in kilometers>]
@@ -135,12 +163,13 @@ class ArgumentParser(argparse.ArgumentParser):
         xgroup.add_argument('-view',     metavar='db_name', action='store', dest='db_view'  , help='make an image from tiles')
         xgroup.add_argument('-server',   metavar='db_name', action='store', dest='db_server', help='connect to dabase through http')
         xgroup.add_argument('-stat',     metavar='db_name', action='store', dest='db_stat'  , help='statistics')
+        xgroup.add_argument('-rebuild',  metavar='db_name', action='store', dest='db_rebuild', help='rebuild database summary')
 
         agroup = self.add_argument_group('Database properties')
         if sqlite3_available:
-            db_ids  = ('maverick', 'folder', 'rmaps', 'kahelo')
+            db_ids  = ('maverick', 'folder', 'rmaps', 'kahelo', 'mbtiles', 'archive')
         else:
-            db_ids  = ('maverick', 'folder')
+            db_ids  = ('maverick', 'folder', 'archive')
         img_ids = ('png', 'jpg', 'server')
         agroup.add_argument('-db_format'   , action='store', dest='db_format', choices=db_ids)
         agroup.add_argument('-tile_format' , action='store', dest='tile_format', choices=img_ids)
@@ -200,7 +229,7 @@ class ArgumentParser(argparse.ArgumentParser):
                            options.db_insert   or options.db_import or
                            options.db_export   or options.db_delete or
                            options.db_view     or options.db_stat   or
-                           options.db_server   or None)
+                           options.db_server   or options.db_rebuild or None)
 
         # expand url aliases
         if options.url_template == 'OpenStreetMap':
@@ -208,8 +237,8 @@ class ArgumentParser(argparse.ArgumentParser):
         if options.url_template == 'MapQuest':
             options.url_template = r'http://otile[1234].mqcdn.com/tiles/1.0.0/osm/{z}/{x}/{y}.jpg'
 
-        # nothing more to do for -describe or -server
-        if options.db_describe or options.db_server:
+        # nothing more to do for -describe, -server or -rebuild
+        if options.db_describe or options.db_server or options.db_rebuild:
             return options
 
         complete_source(options)
@@ -397,12 +426,22 @@ DEFAULTS = \
 [database]
 tile_validity = 3650                    ; number of days, 0 to ignore
 commit_period = 100
+journal_mode = WAL                      ; journal mode of kahelo databases written by a command
+synchronous = NORMAL                    ; OFF, NORMAL, FULL or EXTRA
+page_size = 4096                        ; bytes, applied when creating a sqlite database
+cache_size = -16000                     ; pages, or KiB if negative
+mmap_size = 268435456                   ; bytes of sqlite database read with memory mapping, 0 to disable
+vacuum_threshold = 25                   ; percentage of free pages over which sqlite databases are rebuilt after -delete
 
 [insert]
-request_delay = 0.05                    ; seconds
+rate = 20                               ; requests per second per tile server host, 0 for no limit
+burst = 10                              ; requests allowed in a burst per host
 timeout = 3                             ; seconds
 number_of_attempts = 3
 session_max = 1000000
+workers = 4                             ; number of concurrent downloads
+queue_depth = 64                        ; tiles waiting between two stages of insertion
+pool_size = 4                           ; idle connections kept open per tile server host
 
 [import/export]
 draw_tile_limits = False                ; True or False
@@ -424,6 +463,7 @@ interpolated_points = False             ; show points and circles at interpolate
 
 [tiles]
 jpeg_quality = 85                       ; 1 (very poor) to 100 (lossless)
+processes = 1                           ; processes converting tiles, 1 for no extra process, 0 for all cores
 background_color = 32 32 32             ; RGB
 missing_tile_color = 128 128 128        ; RGB
 border_valid_color = 255 255 255 128    ; RGBA
@@ -512,18 +552,35 @@ def getconfig(options, config_filename):
     options.server   = SubOptions()
     options.Tracks   = SubOptions() # tracks is used for tileset
 
+    # defaults first, so that configuration files from older versions are
+    # completed with the entries they are missing
     config = KaheloConfigParser()
+    config.read_string(DEFAULTS)
     config.read(config_filename)
 
     # [database]
     options.database.tile_validity = config.getint('database', 'tile_validity')
     options.database.commit_period = config.getint('database', 'commit_period')
+    options.database.journal_mode = config.get('database', 'journal_mode').upper()
+    options.database.synchronous = config.get('database', 'synchronous').upper()
+    options.database.page_size = config.getint('database', 'page_size')
+    options.database.cache_size = config.getint('database', 'cache_size')
+    options.database.mmap_size = config.getint('database', 'mmap_size')
+    options.database.vacuum_threshold = config.getfloat('database', 'vacuum_threshold')
+    if options.database.journal_mode not in ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'):
+        error('incorrect journal_mode in configuration file')
+    if options.database.synchronous not in SYNCHRONOUS_LEVELS:
+        error('incorrect synchronous in configuration file')
 
     # [insert]
-    options.insert.request_delay = config.getfloat('insert', 'request_delay')
+    options.insert.rate = config.getfloat('insert', 'rate')
+    options.insert.burst = max(1, config.getint('insert', 'burst'))
     options.insert.timeout = config.getfloat('insert', 'timeout')
     options.insert.number_of_attempts = config.getint('insert', 'number_of_attempts')
     options.insert.session_max = config.getint('insert', 'session_max')
+    options.insert.workers = max(1, config.getint('insert', 'workers'))
+    options.insert.queue_depth = max(1, config.getint('insert', 'queue_depth'))
+    options.insert.pool_size = max(0, config.getint('insert', 'pool_size'))
 
     # [import/export]
     options.Import.draw_tile_limits = config.getboolean('import/export', 'draw_tile_limits')
@@ -545,6 +602,7 @@ def getconfig(options, config_filename):
 
     # [tiles]
     options.tiles.jpeg_quality = config.getint('tiles', 'jpeg_quality')
+    options.tiles.processes = max(0, config.getint('tiles', 'processes'))
     options.tiles.background_color = config.getcolor('tiles', 'background_color', 3)
     options.tiles.missing_tile_color = config.getcolor('tiles', 'missing_tile_color', 3)
     options.tiles.border_valid_color = config.getcolor('tiles', 'border_valid_color', 4)
@@ -603,17 +661,19 @@ def apply_command(options):
     elif options.db_insert:
         do_insert(options.db_name, options)
     elif options.db_import:
-        do_import(options.db_name, options)
+        return do_import(options.db_name, options)
     elif options.db_export:
-        do_export(options.db_name, options)
+        return do_export(options.db_name, options)
     elif options.db_delete:
-        do_delete(options.db_name, options)
+        return do_delete(options.db_name, options)
     elif options.db_view:
         do_makeview(options.db_name, options)
     elif options.db_server:
         do_server(options.db_name, options)
     elif options.db_stat:
         do_statistics(options.db_name, options)
+    elif options.db_rebuild:
+        do_rebuild(options.db_name, options)
     else:
         error('no command given')
 
@@ -630,15 +690,24 @@ def deg2tilecoord(lat_deg, lon_deg, zoom):
     given zoom.
     """
     try:
-        lat_rad = math.radians(lat_deg)
+        xmerc, ymerc = deg2mercator(lat_deg, lon_deg)
         n = 2.0 ** zoom
-        xtile = (lon_deg + 180.0) / 360.0 * n
-        ytile = (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n
-        return xtile, ytile
+        return xmerc * n, ymerc * n
     except:
         error('error converting (%.4f, %.4f, %d) to tile' % (lat_deg, lon_deg, zoom))
 
 
+def deg2mercator(lat_deg, lon_deg):
+    """
+    Convert latitude,longitude coordinates in degrees into normalized Web
+    Mercator coordinates (tile coordinates at zoom 0, between 0 and 1).
+    """
+    lat_rad = math.radians(lat_deg)
+    xmerc = (lon_deg + 180.0) / 360.0
+    ymerc = (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0
+    return xmerc, ymerc
+
+
 def deg2tile(lat_deg, lon_deg, zoom):
     """
     Convert latitude,longitude coordinates in degrees into tile units (rounded)
@@ -745,35 +814,65 @@ def binding_box(tiles):
 
 
 def interior(tiles):
+    # fill contour given by tiles: the result is made of the contour tiles
+    # and of the tiles not connected to the binding box border. Free tiles
+    # are handled by runs between contour tiles in each column, so that memory
+    # depends on contour length and not on area. Return a dict x -> sorted
+    # runs of rows (y0, y1) of the filled tiles.
     xmin, ymin, xmax, ymax = binding_box(tiles)
 
-    map = dict()
-    for x in range(xmin, xmax + 1):
-        map[x] = dict()
-        for y in range(ymin, ymax + 1):
-            map[x][y] = 0
-
+    rows = dict()
     for x, y in tiles:
-        map[x][y] = 1
+        rows.setdefault(x, []).append(y)
 
-    stack = []
-    for x in range(xmin, xmax + 1):
-        stack.extend(((x, ymin), (x, ymax)))
-    for y in range(ymin, ymax + 1):
-        stack.extend(((xmin, y), (xmax, y)))
-
-    while len(stack) > 1:
-        x, y = stack.pop()
-        if xmin <= x <= xmax and ymin <= y <= ymax:
-            if map[x][y] == 0:
-                map[x][y] = 2
-                stack.extend(((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)))
-
-    res = []
+    # free runs (y0, y1) in each column, ordered by y
+    runs = dict()
     for x in range(xmin, xmax + 1):
-        for y in range(ymin, ymax + 1):
-            if map[x][y] <= 1:
-                res.append((x, y))
+        column = []
+        start = ymin
+        for y in sorted(set(rows.get(x, ()))):
+            if y > start:
+                column.append((start, y - 1))
+            start = y + 1
+        if start <= ymax:
+            column.append((start, ymax))
+        runs[x] = column
+    starts = dict((x, [y0 for y0, y1 in column]) for x, column in runs.items())
+
+    # flood fill from runs touching the border
+    outside = set()
+    stack = [(x, index) for x, column in runs.items() for index, (y0, y1) in enumerate(column)
+             if x in (xmin, xmax) or y0 == ymin or y1 == ymax]
+    while stack:
+        x, index = stack.pop()
+        if (x, index) in outside:
+            continue
+        outside.add((x, index))
+        y0, y1 = runs[x][index]
+        for x2 in (x - 1, x + 1):
+            if xmin <= x2 <= xmax:
+                # runs of column x2 sharing at least one row with run
+                index2 = max(bisect.bisect_right(starts[x2], y0) - 1, 0)
+                column2 = runs[x2]
+                while index2 < len(column2) and column2[index2][0] <= y1:
+                    if column2[index2][1] >= y0 and (x2, index2) not in outside:
+                        stack.append((x2, index2))
+                    index2 += 1
+
+    # filled runs are the intervals between outside runs
+    res = dict()
+    for x, column in runs.items():
+        filled = []
+        start = ymin
+        for index, (y0, y1) in enumerate(column):
+            if (x, index) in outside:
+                if y0 > start:
+                    filled.append((start, y0 - 1))
+                start = y1 + 1
+        if start <= ymax:
+            filled.append((start, ymax))
+        if filled:
+            res[x] = filled
 
     return res
 
@@ -833,12 +932,14 @@ def circle_tiles(x, y, zoom, radius_km, tiles):
 
 
 def expand_tiles(segments, options, zoom, radius_km):
-    tiles = set()
-
     if radius_km is None:
         x, y = segments[0][0]
         radius_km = default_radius(x, y, zoom)
 
+    if numpy_available:
+        return expand_tiles_numpy(segments, options, zoom, radius_km)
+
+    tiles = set()
     for segment in segments:
         if options.Tracks.interpolate_points is False:
             tilelist = segment
@@ -857,12 +958,110 @@ def expand_tiles(segments, options, zoom, radius_km):
     return list([(x, y) for x, y in tiles if tilemin <= x <= tilemax and tilemin <= y <= tilemax])
 
 
+def expand_tiles_numpy(segments, options, zoom, radius_km):
+    # same result as expand_tiles with arrays, disks are rasterized as column
+    # intervals which are merged before enumerating tiles.
+    points = set()
+    for segment in segments:
+        if options.Tracks.interpolate_points is False:
+            points.update(segment)
+        else:
+            points.update(interpolate_points(segment))
+    points = list(points)
+
+    x = numpy.array([point[0] for point in points], dtype=numpy.float64)
+    y = numpy.array([point[1] for point in points], dtype=numpy.float64)
+    if radius_km == 0:
+        xs = x.astype(numpy.int64)
+        ymin = ymax = y.astype(numpy.int64)
+    else:
+        radius_tu = tile_hdistance_tu_numpy(x, y, zoom, radius_km)
+        xs, ymin, ymax = disk_intervals_numpy(x, y, radius_tu)
+
+    xs, ymin, ymax = merge_intervals_numpy(xs, ymin, ymax, 2 ** zoom - 1)
+
+    # enumerate tiles of intervals
+    lengths = ymax + 1 - ymin
+    xs = numpy.repeat(xs, lengths)
+    ys = numpy.repeat(ymin, lengths) + ranks_numpy(lengths)
+    return list(zip(xs.tolist(), ys.tolist()))
+
+
+def tile_hdistance_tu_numpy(x, y, zoom, d):
+    # same as tile_hdistance_tu on arrays, with the same sequence of
+    # operations. numpy and math functions may differ in the last bit which
+    # changes tiles only for disks bounded at a tile border within rounding.
+    n = 2.0 ** zoom
+    lon = x / n * 360.0 - 180.0
+    lat = numpy.radians(numpy.degrees(numpy.arctan(numpy.sinh(numpy.pi * (1 - 2 * y / n)))))
+    shift = 2 * numpy.arcsin(numpy.clip(math.sin(d / 2.0 / EARTH_RADIUS) / numpy.cos(lat), -1, 1))
+    lon2 = numpy.degrees(numpy.radians(lon) - shift)
+    x2 = (lon2 + 180.0) / 360.0 * n
+    return numpy.abs(x - x2)
+
+
+def disk_intervals_numpy(x, y, radius_tu):
+    # return the tiles added by circle_tiles for each point as column
+    # intervals (x, ymin, ymax)
+    x0 = x - radius_tu
+    x1 = x + radius_tu
+    xs = [x0.astype(numpy.int64), x.astype(numpy.int64), x.astype(numpy.int64)]
+    ymin = [y.astype(numpy.int64), (y + radius_tu).astype(numpy.int64), (y - radius_tu).astype(numpy.int64)]
+    ymax = list(ymin)
+
+    # columns int(x0) + 1 to int(x1) of each point, rows int(y0) to int(y1)
+    # are added to the column and to the previous one
+    first = x0.astype(numpy.int64) + 1
+    ncols = x1.astype(numpy.int64) + 1 - first
+    point = numpy.repeat(numpy.arange(len(x)), ncols)
+    xt = first[point] + ranks_numpy(ncols)
+    h = numpy.sqrt(numpy.maximum(radius_tu[point] * radius_tu[point] - (xt - x[point]) * (xt - x[point]), 0))
+    y0 = (y[point] - h).astype(numpy.int64)
+    y1 = (y[point] + h).astype(numpy.int64)
+    xs.extend((xt, xt - 1))
+    ymin.extend((y0, y0))
+    ymax.extend((y1, y1))
+
+    return numpy.concatenate(xs), numpy.concatenate(ymin), numpy.concatenate(ymax)
+
+
+def merge_intervals_numpy(xs, ymin, ymax, tilemax):
+    # clip column intervals to the map and merge overlapping or adjacent ones
+    ymin = numpy.maximum(ymin, 0)
+    ymax = numpy.minimum(ymax, tilemax)
+    inside = (xs >= 0) & (xs <= tilemax) & (ymin <= ymax)
+    xs, ymin, ymax = xs[inside], ymin[inside], ymax[inside]
+    if len(xs) == 0:
+        return xs, ymin, ymax
+
+    order = numpy.lexsort((ymin, xs))
+    xs, ymin, ymax = xs[order], ymin[order], ymax[order]
+
+    # highest row reached in the column by the previous intervals
+    reach = numpy.maximum.accumulate((xs << 32) | ymax) & 0xFFFFFFFF
+    start = numpy.ones(len(xs), dtype=bool)
+    start[1:] = (xs[1:] != xs[:-1]) | (ymin[1:] > reach[:-1] + 1)
+    first = numpy.flatnonzero(start)
+    last = numpy.append(first[1:], len(xs)) - 1
+    return xs[first], ymin[first], reach[last]
+
+
+def ranks_numpy(counts):
+    # 0 to count - 1 for each count
+    starts = numpy.cumsum(counts) - counts
+    return numpy.arange(counts.sum()) - numpy.repeat(starts, counts)
+
+
 # -- Parsing gpx files -------------------------------------------------------
 
 
 # cache for gpx trees as parsing is expensive
 GpxCache = dict()
 
+# cache for gpx tracks in normalized mercator coordinates, projection is done
+# once for all zoom levels
+MercatorCache = dict()
+
 
 def namespace(root):
     # http://www.topografix.com/GPX/1/0
@@ -939,11 +1138,33 @@ def track_segments(filename, zoom, options):
 def track_segments_gpx(gpx_filename, zoom, options):
     """Return the list of all segments in gpx file in tile units."""
 
+    # scaling stays on tuples: segments are extended by the generators and
+    # their points are hashed, converting an array product back to tuples
+    # costs more than the product itself
+    n = 2.0 ** zoom
+    return [[(xmerc * n, ymerc * n) for xmerc, ymerc in segment]
+            for segment in mercator_segments_gpx(gpx_filename)]
+
+
+def mercator_segments_gpx(gpx_filename):
+    """Return the list of all segments in gpx file in normalized mercator coordinates."""
+
+    global MercatorCache
+
+    if gpx_filename in MercatorCache:
+        return MercatorCache[gpx_filename]
+
     gpx = read_gpx(gpx_filename)
     segments = []
     for track in gpx:
         for segment in track:
-            segments.append([deg2tilecoord(lat, lon, zoom) for lat,lon in segment])
+            try:
+                segments.append([deg2mercator(lat, lon) for lat,lon in segment])
+            except:
+                error('error converting track of %s to tiles' % gpx_filename)
+
+    MercatorCache[gpx_filename] = segments
+
     return segments
 
 
@@ -1004,28 +1225,209 @@ def track_points_project(project_filename, zoom, options):
 # -- Generation of tile sets -------------------------------------------------
 
 
-class TileSet(set):
+class TileSet:
+    # tiles are stored by zoom level and column as sorted runs of rows
+    # (y0, y1) without overlapping or contiguous runs, iteration is done in
+    # sorted order. Lists of runs are never modified, they may be shared by
+    # columns and tile sets.
+    def __init__(self, tiles=()):
+        self.zooms = dict()
+        self.update(tiles)
+
+    def update(self, tiles):
+        if isinstance(tiles, TileSet):
+            for zoom, columns in tiles.zooms.items():
+                for x, runs in columns.items():
+                    self.add_runs(zoom, x, runs)
+            return
+
+        # group rows by column, by chunks to limit memory
+        tiles = iter(tiles)
+        while True:
+            rows = dict()
+            for x, y, zoom in itertools.islice(tiles, TILESET_CHUNK):
+                rows.setdefault((zoom, x), []).append(y)
+            if not rows:
+                break
+            for (zoom, x), ys in rows.items():
+                self.add_runs(zoom, x, runs_from_rows(ys))
+
+    def add_runs(self, zoom, x, runs):
+        columns = self.zooms.setdefault(zoom, dict())
+        if x in columns:
+            columns[x] = merge_runs(columns[x], runs)
+        else:
+            columns[x] = runs
+
+    def add_rect(self, zoom, xmin, ymin, xmax, ymax):
+        if ymin <= ymax:
+            runs = [(ymin, ymax)]
+            for x in range(xmin, xmax + 1):
+                self.add_runs(zoom, x, runs)
+
     def size(self):
-        return len(self)
+        return sum(y1 - y0 + 1 for columns in self.zooms.values()
+                   for runs in columns.values() for y0, y1 in runs)
+
+    def __len__(self):
+        return self.size()
+
+    def __iter__(self):
+        for zoom in sorted(self.zooms):
+            columns = self.zooms[zoom]
+            for x in sorted(columns):
+                for y0, y1 in columns[x]:
+                    for y in range(y0, y1 + 1):
+                        yield x, y, zoom
+
+    def runs(self):
+        # iterate on (zoom, x, y0, y1) in sorted order
+        for zoom in sorted(self.zooms):
+            columns = self.zooms[zoom]
+            for x in sorted(columns):
+                for y0, y1 in columns[x]:
+                    yield zoom, x, y0, y1
+
+    def __contains__(self, tile):
+        x, y, zoom = tile
+        runs = self.zooms.get(zoom, {}).get(x)
+        if not runs:
+            return False
+        index = bisect.bisect_right(runs, (y, float('inf'))) - 1
+        return index >= 0 and runs[index][1] >= y
 
     def sorted(self):
-        return sorted(self, key=lambda x: (x[2], *x[:2]))
+        # iterate in zoom, x, y order
+        return iter(self)
+
+    def binding_box(self):
+        xmin, ymin, xmax, ymax = 1000000000, 1000000000, 0, 0
+        for columns in self.zooms.values():
+            xmin = min([xmin] + list(columns))
+            xmax = max([xmax] + list(columns))
+            for runs in columns.values():
+                ymin = min(ymin, runs[0][0])
+                ymax = max(ymax, runs[-1][1])
+        return xmin, ymin, xmax, ymax
+
+    def intersection(self, tiles):
+        if not isinstance(tiles, TileSet):
+            return TileSet(tile for tile in tiles if tile in self)
+        result = TileSet()
+        for zoom, columns in self.zooms.items():
+            columns2 = tiles.zooms.get(zoom, {})
+            for x, runs in columns.items():
+                if x in columns2:
+                    runs = intersect_runs(runs, columns2[x])
+                    if runs:
+                        result.add_runs(zoom, x, runs)
+        return result
+
+    def rectangles(self):
+        # return list of (zoom, xmin, ymin, xmax, ymax, number of tiles) if the
+        # tiles of each zoom fill a rectangle, None otherwise
+        result = []
+        for zoom in sorted(self.zooms):
+            columns = self.zooms[zoom]
+            xmin, xmax = min(columns), max(columns)
+            ymin = min(runs[0][0] for runs in columns.values())
+            ymax = max(runs[-1][1] for runs in columns.values())
+            count = sum(y1 - y0 + 1 for runs in columns.values() for y0, y1 in runs)
+            if count != (xmax - xmin + 1) * (ymax - ymin + 1):
+                return None
+            result.append((zoom, xmin, ymin, xmax, ymax, count))
+        return result
+
+
+# number of tiles grouped by column at once when updating a tile set
+TILESET_CHUNK = 100000
+
+
+def runs_from_rows(ys):
+    # return sorted runs of rows from a list of rows
+    runs = []
+    for y in sorted(ys):
+        if runs and y <= runs[-1][1] + 1:
+            if y > runs[-1][1]:
+                runs[-1] = (runs[-1][0], y)
+        else:
+            runs.append((y, y))
+    return runs
+
+
+def merge_runs(runs1, runs2):
+    # union of two lists of runs
+    result = []
+    for y0, y1 in heapq.merge(runs1, runs2):
+        if result and y0 <= result[-1][1] + 1:
+            if y1 > result[-1][1]:
+                result[-1] = (result[-1][0], y1)
+        else:
+            result.append((y0, y1))
+    return result
+
+
+def intersect_runs(runs1, runs2):
+    # intersection of two lists of runs
+    result = []
+    i, j = 0, 0
+    while i < len(runs1) and j < len(runs2):
+        y0 = max(runs1[i][0], runs2[j][0])
+        y1 = min(runs1[i][1], runs2[j][1])
+        if y0 <= y1:
+            result.append((y0, y1))
+        if runs1[i][1] < runs2[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+class DatabaseTileSet:
+    # tiles of a database for -records, read from database when enumerated
+    def __init__(self, db, zooms):
+        self.db = db
+        self.zooms = sorted(set(zooms))
+
+    def __iter__(self):
+        return iter(self.db.list_tiles(self.zooms))
+
+    def size(self):
+        return self.db.count_tiles(self.zooms)
+
+    def sorted(self):
+        return self.db.list_tiles(self.zooms)
 
     def binding_box(self):
         return binding_box(self)
 
+    def rectangles(self):
+        # whole zoom levels
+        return [(zoom, 0, 0, 2 ** zoom - 1, 2 ** zoom - 1, self.db.count_tiles((zoom,)))
+                for zoom in self.zooms]
+
 
 def subdivise(tiles, zoom_current, zoom_target):
     """
-    Subdivise a list of tiles at level zoom_current into tiles at level zoom_target.
+    Subdivise a list of tiles (x, y) or a TileSet at level zoom_current into
+    tiles at level zoom_target.
+    Return a TileSet where the columns subdividing a column share its runs.
     """
-    coords = list()
     ratio = 2 ** (zoom_target - zoom_current)
-    for x, y in tiles:
-        for X in range(ratio):
-            for Y in range(ratio):
-                coords.append((x * ratio + X, y * ratio + Y, zoom_target))
-    return coords
+    if isinstance(tiles, TileSet):
+        columns = tiles.zooms.get(zoom_current, {})
+    else:
+        rows = dict()
+        for x, y in tiles:
+            rows.setdefault(x, []).append(y)
+        columns = dict((x, runs_from_rows(ys)) for x, ys in rows.items())
+
+    tileset = TileSet()
+    for x, runs in columns.items():
+        runs = [(y0 * ratio, y1 * ratio + ratio - 1) for y0, y1 in runs]
+        for X in range(x * ratio, (x + 1) * ratio):
+            tileset.add_runs(zoom_target, X, runs)
+    return tileset
 
 
 # filtering with database and zoom
@@ -1037,9 +1439,9 @@ def filter_tileset_with_db(tileset, db, zoom):
     activated with the -inside parameter and useless with some commands (-insert
     and -import).
     """
-    db_tiles = db.list_tiles((zoom,))
-    tileset = set(db_tiles).intersection(tileset)
-    return tileset
+    if not isinstance(tileset, TileSet):
+        tileset = TileSet(tileset)
+    return tileset.intersection(db.list_tiles((zoom,)))
 
 
 def filter_tileset_with_zoom(tileset, zoom):
@@ -1049,7 +1451,8 @@ def filter_tileset_with_zoom(tileset, zoom):
 
 
 # track and contour tile generators
-# the next four functions return a list of (x, y)
+# track and disk generators return a list of (x, y), contour generators
+# return a TileSet
 
 
 def tile_track_generator(options, gpx_filename, zoom, radius):
@@ -1095,7 +1498,7 @@ def tile_tracks_generator(options, gpx_filename, zoom, radius):
 
 
 def tile_contour_generator(options, gpx_filename, zoom, radius):
-    # return list of tiles for contour
+    # return tile set for contour
     # segments are considered connected
 
     segments = track_segments(gpx_filename, zoom, options)
@@ -1107,23 +1510,26 @@ def tile_contour_generator(options, gpx_filename, zoom, radius):
         segment.append(segments[next][0])
 
     tiles = expand_tiles(segments, options, zoom, radius)
-    return interior(tiles)
+    tileset = TileSet()
+    for x, runs in interior(tiles).items():
+        tileset.add_runs(zoom, x, runs)
+    return tileset
 
 
 def tile_contours_generator(options, gpx_filename, zoom, radius):
-    # return list of tiles for contours
+    # return tile set for contours
     # each segment is considered as a separate contour
 
     segments = track_segments(gpx_filename, zoom, options)
 
-    all_tiles = set()
+    tileset = TileSet()
     for segment in segments:
         segment.append(segment[0])
         tiles = expand_tiles((segment,), options, zoom, radius)
-        for x in interior(tiles):
-            all_tiles.add(x)
+        for x, runs in interior(tiles).items():
+            tileset.add_runs(zoom, x, runs)
 
-    return list(all_tiles)
+    return tileset
 
 
 # tile set generator for -track, -contour, -contours
@@ -1158,7 +1564,10 @@ def tile_list_generate_level(options, generator, source, zoom, radius, db_source
     if zoom <= options.zoom_limit:
         # no subdivision required
         gen0 = generator(options, source, zoom, radius)
-        gen = ((x, y, zoom) for x, y in gen0)
+        if isinstance(gen0, TileSet):
+            gen = gen0
+        else:
+            gen = ((x, y, zoom) for x, y in gen0)
     else:
         # prepare tile coordinates for subdivision
         gen0 = generator(options, source, options.zoom_limit, radius)
@@ -1169,7 +1578,7 @@ def tile_list_generate_level(options, generator, source, zoom, radius, db_source
     else:
         tileset = gen
 
-    return TileSet(tileset)
+    return tileset if isinstance(tileset, TileSet) else TileSet(tileset)
 
 
 # tile set generator for -project
@@ -1239,8 +1648,7 @@ def db_tiles_generator(options, source, zooms, radius, db_source):
     if radius:
         error('radius is not used for -record tile set')
 
-    tiles = db_source.list_tiles(zooms)
-    return TileSet(tiles)
+    return DatabaseTileSet(db_source, zooms)
 
 
 # tile set generator for -tiles
@@ -1258,14 +1666,13 @@ def coord_tiles_generator(options, source, zooms, radius, db_source, db_filter):
         zoom = zooms[0]
 
     xmin, ymin, xmax, ymax = options.coord_tiles
-    gen = ((x, y, zoom) for x in range(xmin, xmax + 1) for y in range(ymin, ymax + 1))
+    tileset = TileSet()
+    tileset.add_rect(zoom, xmin, ymin, xmax, ymax)
 
     if options.inside:
-        tileset = filter_tileset_with_db(gen, db_source, zoom)
-    else:
-        tileset = gen
+        tileset = filter_tileset_with_db(tileset, db_source, zoom)
 
-    return TileSet(tileset)
+    return tileset
 
 
 # tile set factory
@@ -1299,6 +1706,11 @@ def tileset(options, db, db_filter=False):
 # -- Database classes --------------------------------------------------------
 
 
+def to_str(value):
+    # text values are read as bytes from sqlite databases
+    return value.decode() if isinstance(value, bytes) else value
+
+
 class TileDatabase:
     def __init__(self, fullname, tile_format, url_template):
         self.fullname = fullname
@@ -1341,6 +1753,10 @@ class TileDatabase:
         # return (True, date) if exists else (False, None)
         pass
 
+    def exists_many(self, tiles):
+        # return dict (x, y, zoom) -> (exists, date) for a batch of tiles
+        return dict((tile, self.exists(*tile)) for tile in tiles)
+
     def upper_tile(self, x, y, zoom):
         for z in range(zoom - 1, 0, -1):
             scale = 2 ** (zoom - z)
@@ -1359,13 +1775,69 @@ class TileDatabase:
         # return (True, date, image_buffer) if exists else (False, None, None)
         pass
 
-    def update(self, date, x, y, zoom, tile):
+    def validators(self, x, y, zoom):
+        # return http validators (etag, last_modified) stored with tile if any
+        return None, None
+
+    def update(self, date, x, y, zoom, tile, validators=(None, None)):
+        pass
+
+    def update_many(self, rows):
+        # rows are (date, x, y, zoom, tile, validators)
+        for row in rows:
+            self.update(*row)
+
+    def touch(self, date, x, y, zoom):
+        # update date of tile, used when tile is unchanged on server
         pass
 
+    def delete_range(self, zoom, xmin, ymin, xmax, ymax):
+        # delete tiles in rectangle and return their number, None if the
+        # database does not delete by rectangles
+        return None
+
+    def count_records(self, zooms, expiry_date):
+        # return numbers of up to date and expired tiles of zooms without
+        # enumerating them, None if not available
+        return None
+
+    def count_range(self, zoom, xmin, ymin, xmax, ymax, expiry_date):
+        # return numbers of up to date and expired tiles in rectangle, None
+        # if the database does not count by rectangles
+        return None
+
+    def count_many(self, tiles, expiry_date):
+        # return numbers of up to date and expired tiles in a batch of tiles
+        uptodate, expired = 0, 0
+        for exists, date in self.exists_many(tiles).values():
+            if exists:
+                if date is None or date > expiry_date:
+                    uptodate += 1
+                else:
+                    expired += 1
+        return uptodate, expired
+
+    def size_summary(self, tiles):
+        # return (zoom, y, number, total, size_min, size_max, x_min, x_max)
+        # for the rows of existing tiles in a batch of tiles
+        result = []
+        for x, y, zoom in tiles:
+            exists, date, buffer = self.retrieve_buffer(x, y, zoom)
+            if exists:
+                size = len(buffer)
+                result.append((zoom, y, 1, size, size, size, x, x))
+        return result
+
+    def summary(self, zooms):
+        # return per row statistics without enumerating tiles, None if not
+        # available
+        return None
+
     def count_tiles(self, zoom):
         pass
 
-    def list_tiles(self, zoom):
+    def list_tiles(self, zooms):
+        # iterate on tiles in zoom, x, y order
         pass
 
     def commit(self):
@@ -1377,37 +1849,222 @@ class TileDatabase:
     def close(self):
         pass
 
+    def settings(self):
+        # return report entries describing storage settings
+        return []
+
 
 class SqliteDatabase(TileDatabase):
-    def __init__(self, db_name, tile_format, url_template):
+    # journal mode is stored in the database file and may prevent other
+    # applications from reading it, it is changed only for kahelo databases
+    sets_journal_mode = False
+
+    def __init__(self, db_name, tile_format, url_template, settings=None, write=False):
         TileDatabase.__init__(self, db_name, tile_format, url_template)
-        self.conn = sqlite3.connect(db_name)
+        # connections may be shared by the threads of the tile server which
+        # serializes accesses
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
         if sys.version_info < (3,):
             self.conn.text_factory = str
         else:
             self.conn.text_factory = bytes
         self.cursor = self.conn.cursor()
+        self.write = write
+        self.duplicates = 0
+        self.vacuum_threshold = 0
+
+        # settings stored in the database file are taken into account only
+        # before creating the first table, databases are created by the first
+        # command opening them whatever the open mode
+        self.execute('SELECT COUNT(*) FROM sqlite_master')
+        if self.cursor.fetchone()[0] == 0:
+            if settings is not None:
+                self.execute('PRAGMA page_size = %d' % settings.page_size)
+            self.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+        if settings is not None:
+            self.apply_settings(settings, write)
+
+    def apply_settings(self, settings, write):
+        # settings of the connection
+        self.vacuum_threshold = settings.vacuum_threshold
+        self.execute('PRAGMA synchronous = %s' % settings.synchronous)
+        self.execute('PRAGMA cache_size = %d' % settings.cache_size)
+        self.execute('PRAGMA mmap_size = %d' % settings.mmap_size)
+
+        # journal mode is stored in the database file, databases opened for
+        # reading are left unchanged
+        if write and self.sets_journal_mode:
+            self.execute('PRAGMA journal_mode = %s' % settings.journal_mode)
+
+    def pragma(self, name):
+        self.execute('PRAGMA %s' % name)
+        return self.cursor.fetchone()[0]
+
+    def settings(self):
+        return [('Journal mode', to_str(self.pragma('journal_mode')).upper()),
+                ('Synchronous', SYNCHRONOUS_LEVELS[self.pragma('synchronous')]),
+                ('Page size', self.pragma('page_size')),
+                ('Cache size', self.pragma('cache_size')),
+                ('Mmap size', self.pragma('mmap_size'))]
 
     def execute(self, request, *args):
         self.cursor.execute(request, args)
 
+    def columns(self, table):
+        self.execute('PRAGMA table_info(%s)' % table)
+        return [to_str(row[1]) for row in self.cursor.fetchall()]
+
+    def lookup(self, tiles, request):
+        # fill temporary table with tiles and return rows of request joining it
+        pending = self.conn.in_transaction
+        self.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (x integer, y integer, zoom integer)')
+        self.execute('DELETE FROM lookup')
+        self.cursor.executemany('INSERT INTO lookup VALUES (?,?,?)', tiles)
+        self.execute(request)
+        rows = self.cursor.fetchall()
+        if not pending:
+            # do not keep database locked by the transaction opened for lookup
+            self.commit()
+        return rows
+
+    def count_many(self, tiles, expiry_date):
+        # tiles without date are up to date
+        date = self.sql_date.format('tiles')
+        rows = self.lookup(list(tiles), 'SELECT COUNT(*), COALESCE(SUM(%s <= %d), 0) FROM lookup JOIN tiles ON %s' %
+                                        (date, expiry_date, self.sql_key.format('tiles', 'lookup')))
+        count, expired = rows[0]
+        return count - expired, expired
+
+    def size_summary(self, tiles):
+        # sizes are computed without reading tiles, text tiles written by
+        # previous versions are measured as blobs
+        size = 'length(CAST(%s AS BLOB))' % self.sql_tile.format('tiles')
+        return self.lookup(list(tiles), 'SELECT lookup.zoom, lookup.y, COUNT(*), SUM({0}), MIN({0}), MAX({0}), '
+                                        'MIN(lookup.x), MAX(lookup.x) FROM lookup JOIN tiles ON {1} '
+                                        'GROUP BY lookup.zoom, lookup.y'.format(size, self.sql_key.format('tiles', 'lookup')))
+
+    def import_sql(self, db_src, tiles, predicate, now):
+        # copy tiles from the tiles table of db_src when predicate on source s
+        # and destination d is verified, return the number of tiles found in
+        # source and the number of tiles copied
+        self.commit()
+        self.execute('ATTACH DATABASE ? AS source', db_src.fullname)
+        try:
+            self.execute('CREATE TEMP TABLE IF NOT EXISTS import_set (x integer, y integer, zoom integer)')
+            self.execute('DELETE FROM import_set')
+            self.cursor.executemany('INSERT INTO import_set VALUES (?,?,?)', tiles)
+            join = 'FROM import_set t JOIN source.tiles s ON %s' % db_src.sql_key.format('s', 't')
+            self.execute('SELECT COUNT(*) ' + join)
+            found = self.cursor.fetchone()[0]
+            join += ' LEFT JOIN main.tiles d ON %s' % self.sql_key.format('d', 't')
+            predicate = predicate.format(src_date=db_src.sql_date.format('s'), dst_date=self.sql_date.format('d'))
+            select = 'SELECT COALESCE(%s, %d) AS date, t.x AS x, t.y AS y, t.zoom AS zoom, %s AS tile %s WHERE %s' % (
+                db_src.sql_date.format('s'), now, db_src.sql_tile.format('s'), join, predicate)
+            self.execute(self.sql_upsert(select))
+            copied = self.cursor.rowcount
+            self.commit()
+        except:
+            # source cannot be detached in a transaction
+            self.conn.rollback()
+            raise
+        finally:
+            self.execute('DETACH DATABASE source')
+        return found, copied
+
+    def unique_key(self, table, index, columns, previous_index):
+        # tiles are identified by a unique index, databases created by previous
+        # versions may contain duplicates, the last inserted ones are kept.
+        # Called only when writing, return the number of duplicates removed
+        self.execute('PRAGMA index_list(%s)' % table)
+        if (index, 1) in [(to_str(row[1]), row[2]) for row in self.cursor.fetchall()]:
+            return 0
+        self.execute('DELETE FROM %s WHERE rowid NOT IN (SELECT MAX(rowid) FROM %s GROUP BY %s)' %
+                     (table, table, columns))
+        duplicates = self.cursor.rowcount
+        self.execute('DROP INDEX IF EXISTS %s' % previous_index)
+        self.execute('DROP INDEX IF EXISTS %s' % index)
+        self.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (index, table, columns))
+        self.commit()
+        return duplicates
+
     def commit(self):
         self.conn.commit()
 
     def pack(self):
-        self.execute('vacuum')
+        # free pages are released at once by databases created with
+        # incremental auto vacuum, other ones are rebuilt when free pages
+        # exceed the threshold
+        if self.pragma('auto_vacuum') == 2:
+            # run as a script, executing the pragma as a query releases a
+            # single page
+            self.conn.executescript('PRAGMA incremental_vacuum')
+        elif self.pragma('freelist_count') > self.vacuum_threshold / 100.0 * self.pragma('page_count'):
+            self.execute('vacuum')
 
     def close(self):
         self.conn.close()
 
 
+# tiles written as text by previous versions are measured as blobs
+SUMMARY_SELECT = ('SELECT zoom, y, COUNT(*), SUM(length(CAST(tile AS BLOB))), '
+                  'MIN(length(CAST(tile AS BLOB))), MAX(length(CAST(tile AS BLOB))), '
+                  'MIN(x), MAX(x), MIN(date), 0 FROM tiles WHERE 1')
+
+SUMMARY_INSERT = """
+    INSERT INTO tile_summary VALUES (new.zoom, new.y, 1, length(CAST(new.tile AS BLOB)),
+                                     length(CAST(new.tile AS BLOB)), length(CAST(new.tile AS BLOB)),
+                                     new.x, new.x, new.date, 0)
+    ON CONFLICT (zoom, y) DO UPDATE SET
+        count = count + 1,
+        bytes = bytes + excluded.bytes,
+        size_min = min(size_min, excluded.size_min),
+        size_max = max(size_max, excluded.size_max),
+        x_min = min(x_min, excluded.x_min),
+        x_max = max(x_max, excluded.x_max),
+        oldest = coalesce(min(oldest, excluded.oldest), oldest, excluded.oldest);
+"""
+
+SUMMARY_DELETE = """
+    UPDATE tile_summary SET
+        count = count - 1,
+        bytes = bytes - length(CAST(old.tile AS BLOB)),
+        stale = stale OR length(CAST(old.tile AS BLOB)) IN (size_min, size_max) OR
+                old.x IN (x_min, x_max) OR old.date IS oldest
+    WHERE zoom = old.zoom AND y = old.y;
+    DELETE FROM tile_summary WHERE zoom = old.zoom AND y = old.y AND count = 0;
+"""
+
+SUMMARY_TRIGGERS = (
+    ('tile_summary_insert', 'AFTER INSERT ON tiles BEGIN %s END' % SUMMARY_INSERT),
+    ('tile_summary_delete', 'AFTER DELETE ON tiles BEGIN %s END' % SUMMARY_DELETE),
+    ('tile_summary_update', 'AFTER UPDATE ON tiles BEGIN %s %s END' % (SUMMARY_DELETE, SUMMARY_INSERT)))
+
+
 class KaheloDatabase(SqliteDatabase):
-    def __init__(self, db_name, tile_format, url_template):
-        SqliteDatabase.__init__(self, db_name, tile_format, url_template)
+    # tiles table in requests joining tile sets and databases
+    sql_key = '{0}.zoom = {1}.zoom AND {0}.x = {1}.x AND {0}.y = {1}.y'
+    sql_date = '{0}.date'
+    sql_tile = '{0}.tile'
+    sets_journal_mode = True
+
+    def __init__(self, db_name, tile_format, url_template, settings=None, write=False):
+        SqliteDatabase.__init__(self, db_name, tile_format, url_template, settings, write)
+        new_database = not self.columns('tiles')
         self.execute('CREATE TABLE IF NOT EXISTS server (template text, format text)')
-        self.execute('CREATE TABLE IF NOT EXISTS tiles (date timestamp, x integer, y integer, zoom integer, tile blob)')
-        self.execute('CREATE INDEX IF NOT EXISTS tile_index ON tiles (x, y, zoom)')
+        self.execute('CREATE TABLE IF NOT EXISTS tiles (date timestamp, x integer, y integer, zoom integer, tile blob, etag text, last_modified text)')
         self.commit()
+        if write:
+            self.duplicates = self.unique_key('tiles', 'tile_key', 'zoom, x, y', 'tile_index')
+
+        # databases created by previous versions do not store http validators,
+        # columns are added when needed
+        self.stores_validators = 'etag' in self.columns('tiles')
+
+        # summary is created with new databases, previous ones use -rebuild
+        if new_database:
+            self.rebuild_summary()
+        self.has_summary = bool(self.columns('tile_summary'))
 
     def __retrieve(self, x, y, zoom):
         # private, return the row including rowid,date
@@ -1423,6 +2080,15 @@ class KaheloDatabase(SqliteDatabase):
         row = self.__retrieve(x, y, zoom)
         return (False, None) if row is None else (True, row[1])
 
+    def exists_many(self, tiles):
+        tiles = list(tiles)
+        result = dict((tile, (False, None)) for tile in tiles)
+        rows = self.lookup(tiles, 'SELECT lookup.x, lookup.y, lookup.zoom, tiles.date FROM lookup '
+                                  'JOIN tiles ON tiles.x = lookup.x AND tiles.y = lookup.y AND tiles.zoom = lookup.zoom')
+        for x, y, zoom, date in rows:
+            result[(x, y, zoom)] = (True, date)
+        return result
+
     def retrieve(self, x, y, zoom):
         row = self.__retrieve_full(x, y, zoom)
         if row is None:
@@ -1438,21 +2104,68 @@ class KaheloDatabase(SqliteDatabase):
         else:
             return (True, row[1], row[2])
 
-    def update(self, date, x, y, zoom, tile_buffer):
-        row = self.__retrieve(x, y, zoom)
-        if row is not None:
-            self.execute("DELETE FROM tiles WHERE rowid = ?", row[0])
-        if date is None:
-            date = int(math.trunc(time()))
-        self.execute("INSERT INTO tiles VALUES (?,?,?,?,?)", date, x, y, zoom, tile_buffer)
+    def validators(self, x, y, zoom):
+        if not self.stores_validators:
+            return None, None
+        self.execute("SELECT etag,last_modified FROM tiles WHERE x = ? AND y = ? AND zoom = ?", x, y, zoom)
+        row = self.cursor.fetchone()
+        if row is None:
+            return None, None
+        else:
+            return to_str(row[0]), to_str(row[1])
+
+    def update(self, date, x, y, zoom, tile_buffer, validators=(None, None)):
+        self.update_many([(date, x, y, zoom, tile_buffer, validators)])
+
+    def update_many(self, rows):
+        rows = list(rows)
+        now = int(math.trunc(time()))
+        if not self.stores_validators and any(row[5] != (None, None) for row in rows):
+            self.execute('ALTER TABLE tiles ADD COLUMN etag text')
+            self.execute('ALTER TABLE tiles ADD COLUMN last_modified text')
+            self.stores_validators = True
+        if self.stores_validators:
+            self.cursor.executemany(
+                "INSERT INTO tiles (date,x,y,zoom,tile,etag,last_modified) VALUES (?,?,?,?,?,?,?) "
+                "ON CONFLICT (zoom, x, y) DO UPDATE SET date = excluded.date, tile = excluded.tile, "
+                "etag = excluded.etag, last_modified = excluded.last_modified",
+                [(now if date is None else date, x, y, zoom, tile_buffer, etag, last_modified)
+                 for date, x, y, zoom, tile_buffer, (etag, last_modified) in rows])
+        else:
+            self.cursor.executemany(
+                "INSERT INTO tiles (date,x,y,zoom,tile) VALUES (?,?,?,?,?) "
+                "ON CONFLICT (zoom, x, y) DO UPDATE SET date = excluded.date, tile = excluded.tile",
+                [(now if date is None else date, x, y, zoom, tile_buffer)
+                 for date, x, y, zoom, tile_buffer, _ in rows])
+
+    def sql_upsert(self, select):
+        # select gives date, x, y, zoom, tile
+        validators = ', etag = NULL, last_modified = NULL' if self.stores_validators else ''
+        return ('INSERT INTO main.tiles (date,x,y,zoom,tile) ' + select +
+                ' ON CONFLICT (zoom, x, y) DO UPDATE SET date = excluded.date, tile = excluded.tile' + validators)
+
+    def touch(self, date, x, y, zoom):
+        self.execute("UPDATE tiles SET date = ? WHERE x = ? AND y = ? AND zoom = ?", date, x, y, zoom)
 
     def delete(self, x, y, zoom):
-        row = self.__retrieve(x, y, zoom)
-        if row is not None:
-            self.execute("DELETE FROM tiles WHERE rowid = ?", row[0])
+        self.execute("DELETE FROM tiles WHERE x = ? AND y = ? AND zoom = ?", x, y, zoom)
         return True
 
+    def delete_range(self, zoom, xmin, ymin, xmax, ymax):
+        self.execute("DELETE FROM tiles WHERE zoom = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?",
+                     zoom, xmin, xmax, ymin, ymax)
+        return self.cursor.rowcount
+
+    def count_range(self, zoom, xmin, ymin, xmax, ymax, expiry_date):
+        self.execute("SELECT COUNT(*), COALESCE(SUM(date <= ?), 0) FROM tiles "
+                     "WHERE zoom = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?",
+                     expiry_date, zoom, xmin, xmax, ymin, ymax)
+        count, expired = self.cursor.fetchone()
+        return count - expired, expired
+
     def count_tiles(self, zooms):
+        if self.has_summary:
+            return sum(row[1] for rows in self.summary(zooms).values() for row in rows)
         R = 0
         for zoom in zooms:
             self.execute('SELECT COUNT(*) FROM tiles WHERE zoom = ?', zoom)
@@ -1460,20 +2173,89 @@ class KaheloDatabase(SqliteDatabase):
             R += r[0][0]
         return R
 
-    def list_tiles(self, zooms):
-        R = []
+    # The summary table gives for each row of tiles (zoom, y) the number of
+    # tiles, their total size, their minimum and maximum sizes and x, and the
+    # oldest date. It is maintained by triggers. Deleting or replacing a tile
+    # may invalidate a minimum or a maximum, the summary row is then marked
+    # as stale and computed again when read.
+
+    def rebuild_summary(self):
+        self.execute('DROP TABLE IF EXISTS tile_summary')
+        self.execute('CREATE TABLE tile_summary (zoom integer, y integer, count integer, bytes integer, '
+                     'size_min integer, size_max integer, x_min integer, x_max integer, oldest timestamp, '
+                     'stale integer, PRIMARY KEY (zoom, y))')
+        self.execute('INSERT INTO tile_summary ' + SUMMARY_SELECT + ' GROUP BY zoom, y')
+        for name, trigger in SUMMARY_TRIGGERS:
+            self.execute('DROP TRIGGER IF EXISTS %s' % name)
+            self.execute('CREATE TRIGGER %s %s' % (name, trigger))
+        self.commit()
+        self.has_summary = True
+
+    def summary(self, zooms):
+        # return dict zoom -> list of (y, count, bytes, size_min, size_max, x_min, x_max, oldest)
+        if not self.has_summary:
+            return None
+        self.execute('SELECT DISTINCT zoom FROM tile_summary WHERE stale')
+        stale_zooms = [zoom for zoom, in self.cursor.fetchall()]
+        if self.write:
+            for zoom in stale_zooms:
+                self.execute('REPLACE INTO tile_summary ' + SUMMARY_SELECT + ' AND zoom = ? AND y IN '
+                             '(SELECT y FROM tile_summary WHERE zoom = ? AND stale) GROUP BY y', zoom, zoom)
+            if stale_zooms:
+                self.commit()
+            stale_zooms = []
+        R = dict()
         for zoom in zooms:
-            self.execute('SELECT x,y,zoom FROM tiles WHERE zoom = ?', zoom)
-            R.extend(self.cursor.fetchall())
+            self.execute('SELECT y, count, bytes, size_min, size_max, x_min, x_max, oldest, stale '
+                         'FROM tile_summary WHERE zoom = ? ORDER BY y', zoom)
+            rows = self.cursor.fetchall()
+            if zoom in stale_zooms:
+                # databases opened for reading are left unchanged, stale rows
+                # are computed from the tiles
+                self.execute(SUMMARY_SELECT + ' AND zoom = ? AND y IN '
+                             '(SELECT y FROM tile_summary WHERE zoom = ? AND stale) GROUP BY y', zoom, zoom)
+                fresh = dict((row[1], row[1:9]) for row in self.cursor.fetchall())
+                rows = [fresh[row[0]] if row[8] else row for row in rows if not row[8] or row[0] in fresh]
+            rows = [row[:8] for row in rows]
+            if rows:
+                R[zoom] = rows
         return R
 
+    def count_records(self, zooms, expiry_date):
+        if not self.has_summary:
+            return None
+        uptodate, expired = 0, 0
+        for zoom, rows in self.summary(zooms).items():
+            count = sum(row[1] for row in rows)
+            dates = [row[7] for row in rows if row[7] is not None]
+            if dates and min(dates) <= expiry_date:
+                self.execute('SELECT COUNT(*) FROM tiles WHERE zoom = ? AND date <= ?', zoom, expiry_date)
+                n = self.cursor.fetchone()[0]
+            else:
+                n = 0
+            uptodate += count - n
+            expired += n
+        return uptodate, expired
+
+    def list_tiles(self, zooms):
+        # rows are read lazily with a cursor of their own
+        cursor = self.conn.cursor()
+        for zoom in zooms:
+            cursor.execute('SELECT x,y,zoom FROM tiles WHERE zoom = ? ORDER BY x, y', (zoom,))
+            for row in cursor:
+                yield row
+
 
 class RmapsDatabase(SqliteDatabase):
-    def __init__(self, db_name, tile_format, url_template):
-        SqliteDatabase.__init__(self, db_name, tile_format, url_template)
+    # tiles table in requests joining tile sets and databases
+    sql_key = '{0}.z = 17 - {1}.zoom AND {0}.x = {1}.x AND {0}.y = {1}.y'
+    sql_date = 'NULL'
+    sql_tile = '{0}.image'
+
+    def __init__(self, db_name, tile_format, url_template, settings=None, write=False):
+        SqliteDatabase.__init__(self, db_name, tile_format, url_template, settings, write)
         self.execute('CREATE TABLE IF NOT EXISTS android_metadata (locale text)')
         self.execute('CREATE TABLE IF NOT EXISTS tiles (x integer, y integer, z integer, s integer, image blob)')
-        self.execute('CREATE INDEX IF NOT EXISTS IND ON tiles (x, y, z, s)')
         self.execute('CREATE TABLE IF NOT EXISTS info (minzoom integer, maxzoom integer)')
 
         self.execute("SELECT locale FROM android_metadata")
@@ -1482,6 +2264,8 @@ class RmapsDatabase(SqliteDatabase):
             self.execute("INSERT INTO android_metadata VALUES (?)", '',)
             self.execute("INSERT INTO info VALUES (?,?)", 1, 17)
         self.commit()
+        if write:
+            self.duplicates = self.unique_key('tiles', 'tile_key', 'z, x, y, s', 'IND')
 
     def __retrieve(self, x, y, zoom):
         # private, return the row including rowid
@@ -1497,6 +2281,15 @@ class RmapsDatabase(SqliteDatabase):
         row = self.__retrieve(x, y, zoom)
         return (row is not None), None
 
+    def exists_many(self, tiles):
+        tiles = list(tiles)
+        result = dict((tile, (False, None)) for tile in tiles)
+        rows = self.lookup(tiles, 'SELECT lookup.x, lookup.y, lookup.zoom FROM lookup '
+                                  'JOIN tiles ON tiles.x = lookup.x AND tiles.y = lookup.y AND tiles.z = 17 - lookup.zoom')
+        for x, y, zoom in rows:
+            result[(x, y, zoom)] = (True, None)
+        return result
+
     def retrieve(self, x, y, zoom):
         row = self.__retrieve_full(x, y, zoom)
         if row is None:
@@ -1512,18 +2305,34 @@ class RmapsDatabase(SqliteDatabase):
         else:
             return True, None, row[1]
 
-    def update(self, date, x, y, zoom, tile):
-        row = self.__retrieve(x, y, zoom)
-        if row is not None:
-            self.execute("DELETE FROM tiles WHERE rowid = ?", row[0])
-        self.execute("INSERT INTO tiles VALUES (?,?,?,?,?)", x, y, 17 - zoom, 0, tile)
+    def update(self, date, x, y, zoom, tile, validators=(None, None)):
+        self.update_many([(date, x, y, zoom, tile, validators)])
+
+    def update_many(self, rows):
+        self.cursor.executemany(
+            "INSERT INTO tiles (x,y,z,s,image) VALUES (?,?,?,0,?) "
+            "ON CONFLICT (z, x, y, s) DO UPDATE SET image = excluded.image",
+            [(x, y, 17 - zoom, tile) for date, x, y, zoom, tile, _ in rows])
+
+    def sql_upsert(self, select):
+        # select gives date, x, y, zoom, tile
+        return ('INSERT INTO main.tiles (x,y,z,s,image) SELECT x, y, 17 - zoom, 0, tile FROM (' + select +
+                ') WHERE 1 ON CONFLICT (z, x, y, s) DO UPDATE SET image = excluded.image')
 
     def delete(self, x, y, zoom):
-        row = self.__retrieve(x, y, zoom)
-        if row is not None:
-            self.execute("DELETE FROM tiles WHERE rowid = ?", row[0])
+        self.execute("DELETE FROM tiles WHERE x = ? AND y = ? AND z = ?", x, y, 17 - zoom)
         return True
 
+    def delete_range(self, zoom, xmin, ymin, xmax, ymax):
+        self.execute("DELETE FROM tiles WHERE z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?",
+                     17 - zoom, xmin, xmax, ymin, ymax)
+        return self.cursor.rowcount
+
+    def count_range(self, zoom, xmin, ymin, xmax, ymax, expiry_date):
+        self.execute("SELECT COUNT(*) FROM tiles WHERE z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?",
+                     17 - zoom, xmin, xmax, ymin, ymax)
+        return self.cursor.fetchone()[0], 0
+
     def count_tiles(self, zooms):
         R = 0
         for zoom in zooms:
@@ -1533,13 +2342,175 @@ class RmapsDatabase(SqliteDatabase):
         return R
 
     def list_tiles(self, zooms):
-        R = []
+        cursor = self.conn.cursor()
         for zoom in zooms:
-            self.execute('SELECT x,y,z FROM tiles WHERE z = ?', 17 - zoom)
-            rows = self.cursor.fetchall()
-            R.extend([(x, y, zoom) for (x, y, z) in rows])
+            cursor.execute('SELECT x,y FROM tiles WHERE z = ? ORDER BY x, y', (17 - zoom,))
+            for x, y in cursor:
+                yield x, y, zoom
+
+
+class MbtilesDatabase(SqliteDatabase):
+    # rows are numbered from south to north (TMS)
+    sql_key = ('{0}.zoom_level = {1}.zoom AND {0}.tile_column = {1}.x AND '
+               '{0}.tile_row = (1 << {1}.zoom) - 1 - {1}.y')
+    sql_date = 'NULL'
+    sql_tile = '{0}.tile_data'
+
+    def __init__(self, db_name, tile_format, url_template, settings=None, write=False):
+        SqliteDatabase.__init__(self, db_name, tile_format, url_template, settings, write)
+
+        # zoom -> [xmin, ymin, xmax, ymax] of tiles written since last commit
+        self.extent = dict()
+
+        self.execute("SELECT type FROM sqlite_master WHERE name = 'tiles'")
+        row = self.cursor.fetchone()
+        if row is not None and to_str(row[0]) != 'table':
+            error('mbtiles database with deduplicated tiles is not handled')
+        self.execute('CREATE TABLE IF NOT EXISTS metadata (name text, value text)')
+        self.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+        self.commit()
+        if write:
+            self.duplicates = self.unique_key('tiles', 'tile_index', 'zoom_level, tile_column, tile_row', 'tile_index')
+
+    def __retrieve_full(self, x, y, zoom):
+        # private, return the row including tile_blob
+        self.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                     zoom, x, tms_row(y, zoom))
+        return self.cursor.fetchone()
+
+    def exists(self, x, y, zoom):
+        self.execute("SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                     zoom, x, tms_row(y, zoom))
+        return (self.cursor.fetchone() is not None), None
+
+    def exists_many(self, tiles):
+        tiles = list(tiles)
+        result = dict((tile, (False, None)) for tile in tiles)
+        rows = self.lookup(tiles, 'SELECT lookup.x, lookup.y, lookup.zoom FROM lookup '
+                                  'JOIN tiles ON tiles.zoom_level = lookup.zoom AND tiles.tile_column = lookup.x '
+                                  'AND tiles.tile_row = (1 << lookup.zoom) - 1 - lookup.y')
+        for x, y, zoom in rows:
+            result[(x, y, zoom)] = (True, None)
+        return result
+
+    def retrieve(self, x, y, zoom):
+        row = self.__retrieve_full(x, y, zoom)
+        if row is None:
+            return False, None, None
+        else:
+            img = create_image_from_blob(row[0])
+            return True, None, img
+
+    def retrieve_buffer(self, x, y, zoom):
+        row = self.__retrieve_full(x, y, zoom)
+        if row is None:
+            return False, None, None
+        else:
+            return True, None, row[0]
+
+    def update(self, date, x, y, zoom, tile, validators=(None, None)):
+        self.update_many([(date, x, y, zoom, tile, validators)])
+
+    def update_many(self, rows):
+        rows = list(rows)
+        self.cursor.executemany(
+            "INSERT INTO tiles (zoom_level,tile_column,tile_row,tile_data) VALUES (?,?,?,?) "
+            "ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET tile_data = excluded.tile_data",
+            [(zoom, x, tms_row(y, zoom), tile) for date, x, y, zoom, tile, _ in rows])
+        for date, x, y, zoom, tile, _ in rows:
+            extent = self.extent.setdefault(zoom, [x, y, x, y])
+            extent[:] = min(extent[0], x), min(extent[1], y), max(extent[2], x), max(extent[3], y)
+
+    def delete(self, x, y, zoom):
+        self.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                     zoom, x, tms_row(y, zoom))
+        return True
+
+    def delete_range(self, zoom, xmin, ymin, xmax, ymax):
+        self.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? "
+                     "AND tile_row BETWEEN ? AND ?",
+                     zoom, xmin, xmax, tms_row(ymax, zoom), tms_row(ymin, zoom))
+        return self.cursor.rowcount
+
+    def count_range(self, zoom, xmin, ymin, xmax, ymax, expiry_date):
+        self.execute("SELECT COUNT(*) FROM tiles WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? "
+                     "AND tile_row BETWEEN ? AND ?",
+                     zoom, xmin, xmax, tms_row(ymax, zoom), tms_row(ymin, zoom))
+        return self.cursor.fetchone()[0], 0
+
+    def count_tiles(self, zooms):
+        R = 0
+        for zoom in zooms:
+            self.execute('SELECT COUNT(*) FROM tiles WHERE zoom_level = ?', zoom)
+            R += self.cursor.fetchone()[0]
         return R
 
+    def list_tiles(self, zooms):
+        cursor = self.conn.cursor()
+        for zoom in zooms:
+            cursor.execute('SELECT tile_column,tile_row FROM tiles WHERE zoom_level = ? '
+                           'ORDER BY tile_column, tile_row DESC', (zoom,))
+            for x, row in cursor:
+                yield x, tms_row(row, zoom), zoom
+
+    def metadata(self):
+        self.execute('SELECT name,value FROM metadata')
+        return dict((to_str(name), to_str(value)) for name, value in self.cursor.fetchall())
+
+    def set_metadata(self, **entries):
+        for name, value in entries.items():
+            self.execute('DELETE FROM metadata WHERE name = ?', name)
+            if value is not None:
+                self.execute('INSERT INTO metadata VALUES (?,?)', name, value)
+
+    def update_metadata(self, extent, metadata):
+        # bounds and zoom range enclose extent and the ones given by metadata
+        zooms = list(extent)
+        bounds = []
+        for zoom, (xmin, ymin, xmax, ymax) in extent.items():
+            top, left = tile2deg(xmin, ymin, zoom)
+            bottom, right = tile2deg(xmax + 1, ymax + 1, zoom)
+            bounds.append((left, bottom, right, top))
+        if 'minzoom' in metadata and 'maxzoom' in metadata:
+            zooms.extend((int(metadata['minzoom']), int(metadata['maxzoom'])))
+        if 'bounds' in metadata:
+            bounds.append([float(v) for v in metadata['bounds'].split(',')])
+
+        if not zooms:
+            self.set_metadata(minzoom=None, maxzoom=None, bounds=None)
+        else:
+            left = min(b[0] for b in bounds)
+            bottom = min(b[1] for b in bounds)
+            right = max(b[2] for b in bounds)
+            top = max(b[3] for b in bounds)
+            self.set_metadata(minzoom=str(min(zooms)), maxzoom=str(max(zooms)),
+                              bounds='%.6f,%.6f,%.6f,%.6f' % (left, bottom, right, top))
+        if 'name' not in metadata:
+            self.set_metadata(name=os.path.splitext(os.path.basename(self.fullname))[0])
+        self.set_metadata(format=self.tile_ext())
+
+    def commit(self):
+        if self.extent:
+            self.update_metadata(self.extent, self.metadata())
+            self.extent = dict()
+        SqliteDatabase.commit(self)
+
+    def pack(self):
+        # bounds are computed again as tiles may have been deleted
+        self.execute('SELECT zoom_level,MIN(tile_column),MIN(tile_row),MAX(tile_column),MAX(tile_row) '
+                     'FROM tiles GROUP BY zoom_level')
+        extent = dict((zoom, [xmin, tms_row(rmax, zoom), xmax, tms_row(rmin, zoom)])
+                      for zoom, xmin, rmin, xmax, rmax in self.cursor.fetchall())
+        self.update_metadata(extent, dict((name, value) for name, value in self.metadata().items()
+                                          if name not in ('minzoom', 'maxzoom', 'bounds')))
+        SqliteDatabase.commit(self)
+        SqliteDatabase.pack(self)
+
+
+def tms_row(y, zoom):
+    # convert between xyz and tms numbering of rows, conversion is symmetric
+    return 2 ** zoom - 1 - y
+
 
 class FolderDatabase(TileDatabase):
     def __init__(self, db_name, tile_format, url_template):
@@ -1556,6 +2527,35 @@ class FolderDatabase(TileDatabase):
         else:
             return False, None
 
+    def exists_many(self, tiles):
+        # one listing per tile directory, dates are read for existing tiles only
+        result = dict()
+        listings = dict()
+        for tile in tiles:
+            dirname, basename = os.path.split(self.filename(*tile))
+            if dirname not in listings:
+                try:
+                    listings[dirname] = set(os.listdir(dirname))
+                except OSError:
+                    listings[dirname] = set()
+            if basename in listings[dirname]:
+                filename = os.path.join(dirname, basename)
+                result[tile] = (True, int(math.trunc(os.path.getmtime(filename))))
+            else:
+                result[tile] = (False, None)
+        return result
+
+    def size_summary(self, tiles):
+        # sizes are given by file system, files are not read
+        result = []
+        for x, y, zoom in tiles:
+            try:
+                size = os.stat(self.filename(x, y, zoom)).st_size
+            except OSError:
+                continue
+            result.append((zoom, y, 1, size, size, size, x, x))
+        return result
+
     def retrieve(self, x, y, zoom):
         filename = self.filename(x, y, zoom)
         if os.path.exists(filename):
@@ -1579,7 +2579,7 @@ class FolderDatabase(TileDatabase):
         else:
             return False, None, None
 
-    def update(self, date, x, y, zoom, tile):
+    def update(self, date, x, y, zoom, tile, validators=(None, None)):
         filename = self.filename(x, y, zoom)
         path = os.path.dirname(filename)
         try:
@@ -1598,6 +2598,12 @@ class FolderDatabase(TileDatabase):
         except:
             error('unable to save ' + filename)
 
+    def touch(self, date, x, y, zoom):
+        try:
+            os.utime(self.filename(x, y, zoom), (date, date))
+        except:
+            pass
+
     def delete(self, x, y, zoom):
         filename = self.filename(x, y, zoom)
         if os.path.exists(filename):
@@ -1609,40 +2615,42 @@ class FolderDatabase(TileDatabase):
         else:
             return True
 
-    def regexp_filename(self):
-        re_path = r'[^\d](\d+)[^\d](\d+)[^\d]'
-        re_name = r'(\d+)\.%s$' % self.tile_ext()
-        return re_path + re_name
+    def tile_suffix(self):
+        return '.' + self.tile_ext()
+
+    def scan_tiles(self, zooms, function):
+        # iterate on (x, function(names of tiles in x directory)) for each
+        # zoom, x directories are listed in parallel, results in x order
+        with ThreadPoolExecutor(max_workers=FOLDER_SCAN_THREADS) as executor:
+            for zoom in zooms:
+                path = os.path.join(self.fullname, str(zoom))
+                xs = sorted(int(entry.name) for entry in scandir(path)
+                            if entry.name.isdigit() and entry.is_dir())
+                pending = collections.deque()
+                for x in xs:
+                    pending.append((x, executor.submit(function, os.path.join(path, str(x)))))
+                    if len(pending) > 2 * FOLDER_SCAN_THREADS:
+                        x, future = pending.popleft()
+                        yield zoom, x, future.result()
+                while pending:
+                    x, future = pending.popleft()
+                    yield zoom, x, future.result()
 
     def list_tiles(self, zooms):
-        regexp = re.compile(self.regexp_filename())
-        R = []
-        for zoom in zooms:
-            path = os.path.join(self.fullname, str(zoom))
-            for root, dirs, files in os.walk(path):
-                if files:
-                    for filename in files:
-                        fullname = os.path.join(root, filename)
-                        m = regexp.search(fullname)
-                        if m:
-                            zoom, x, y = m.group(1,2,3)
-                            zoom, x, y = int(zoom), int(x), int(y)
-                            R.append((x, y, zoom))
-        return R
+        suffix = self.tile_suffix()
+        def list_y(path):
+            ys = [entry.name[:-len(suffix)] for entry in scandir(path) if entry.name.endswith(suffix)]
+            return sorted(int(y) for y in ys if y.isdigit())
+        for zoom, x, ys in self.scan_tiles(zooms, list_y):
+            for y in ys:
+                yield x, y, zoom
 
     def count_tiles(self, zooms):
-        regexp = re.compile(self.regexp_filename())
-        R = 0
-        for zoom in zooms:
-            path = os.path.join(self.fullname, str(zoom))
-            for root, dirs, files in os.walk(path):
-                if files:
-                    for file in files:
-                        fullname = os.path.join(root, file)
-                        m = regexp.search(fullname)
-                        if m:
-                            R += 1
-        return R
+        suffix = self.tile_suffix()
+        def count_y(path):
+            return sum(1 for entry in scandir(path)
+                       if entry.name.endswith(suffix) and entry.name[:-len(suffix)].isdigit())
+        return sum(count for zoom, x, count in self.scan_tiles(zooms, count_y))
 
     def pack(self):
         for _ in (1, 2):
@@ -1651,6 +2659,14 @@ class FolderDatabase(TileDatabase):
                     os.rmdir(root)
 
 
+def scandir(path):
+    # directory entries, none if directory does not exist
+    try:
+        return list(os.scandir(path))
+    except OSError:
+        return []
+
+
 class MaverickDatabase(FolderDatabase):
     def __init__(self, db_name, tile_format, url_template):
         FolderDatabase.__init__(self, db_name, tile_format, url_template)
@@ -1658,10 +2674,176 @@ class MaverickDatabase(FolderDatabase):
     def filename(self, x, y, zoom):
         return FolderDatabase.filename(self, x, y, zoom) + '.tile'
 
-    def regexp_filename(self):
-        re_path = r'[^\d](\d+)[^\d](\d+)[^\d]'
-        re_name = r'(\d+)\.%s\.tile$' % self.tile_ext()
-        return re_path + re_name
+    def tile_suffix(self):
+        return FolderDatabase.tile_suffix(self) + '.tile'
+
+
+# Archive databases are single files read with a memory mapping. The file
+# starts with a header (magic, version, number of tiles, offset of index)
+# followed by the tiles in index order, and ends with the index made of four
+# arrays: keys (zoom, x, y packed in 64 bits, sorted), offsets, dates (-1 if
+# unknown) and lengths. Integers are little endian. An archive cannot be
+# modified once built: tiles written to a new archive are spooled in a
+# temporary file and the archive is made when the database is closed.
+
+
+ARCHIVE_MAGIC = b'KAHELOAR'
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = struct.Struct('<8sIIQ')
+
+
+def archive_key(x, y, zoom):
+    return (zoom << 58) | (x << 29) | y
+
+
+class ArchiveDatabase(TileDatabase):
+    def __init__(self, db_name, tile_format, url_template):
+        TileDatabase.__init__(self, db_name, tile_format, url_template)
+        if sys.byteorder != 'little':
+            error('archive databases require a little endian machine')
+        self.map = None
+        self.keys = []
+        self.spool = None
+        self.entries = dict()
+        if os.path.isfile(db_name):
+            self.open_archive()
+
+    def open_archive(self):
+        with open(self.fullname, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, index = ARCHIVE_HEADER.unpack_from(self.map)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            error('%s is not a kahelo archive' % self.fullname)
+        view = memoryview(self.map)
+        self.view = view
+        self.keys = view[index:index + 8 * n].cast('Q')
+        self.offsets = view[index + 8 * n:index + 16 * n].cast('Q')
+        self.dates = view[index + 16 * n:index + 24 * n].cast('q')
+        self.lengths = view[index + 24 * n:index + 28 * n].cast('I')
+
+    def __find(self, x, y, zoom):
+        # private, return index of tile in archive or None
+        key = archive_key(x, y, zoom)
+        i = bisect.bisect_left(self.keys, key)
+        return i if i < len(self.keys) and self.keys[i] == key else None
+
+    def exists(self, x, y, zoom):
+        if self.spool is not None:
+            entry = self.entries.get(archive_key(x, y, zoom))
+            return (False, None) if entry is None else (True, entry[2])
+        i = self.__find(x, y, zoom)
+        if i is None:
+            return False, None
+        else:
+            date = self.dates[i]
+            return True, (None if date < 0 else date)
+
+    def retrieve(self, x, y, zoom):
+        exists, date, tile_buffer = self.retrieve_buffer(x, y, zoom)
+        if not exists:
+            return exists, date, None
+        else:
+            return True, date, create_image_from_blob(tile_buffer)
+
+    def retrieve_buffer(self, x, y, zoom):
+        if self.spool is not None:
+            entry = self.entries.get(archive_key(x, y, zoom))
+            if entry is None:
+                return False, None, None
+            offset, length, date = entry
+            self.spool.seek(offset)
+            return True, date, self.spool.read(length)
+        i = self.__find(x, y, zoom)
+        if i is None:
+            return False, None, None
+        else:
+            # slice of the mapping, no copy
+            offset = self.offsets[i]
+            date = self.dates[i]
+            return True, (None if date < 0 else date), self.view[offset:offset + self.lengths[i]]
+
+    def update(self, date, x, y, zoom, tile, validators=(None, None)):
+        if self.map is not None:
+            error('archive database %s cannot be modified' % self.fullname)
+        if self.spool is None:
+            self.spool = open(self.fullname + '.spool', 'w+b')
+        self.spool.seek(0, os.SEEK_END)
+        offset = self.spool.tell()
+        self.spool.write(tile)
+        self.entries[archive_key(x, y, zoom)] = (offset, len(tile), date)
+
+    def delete(self, x, y, zoom):
+        # failure reported by -delete
+        return self.map is None and self.spool is None
+
+    def count_tiles(self, zooms):
+        if self.spool is not None:
+            return len([key for key in self.entries if key >> 58 in zooms])
+        R = 0
+        for zoom in zooms:
+            R += (bisect.bisect_left(self.keys, (zoom + 1) << 58) -
+                  bisect.bisect_left(self.keys, zoom << 58))
+        return R
+
+    def list_tiles(self, zooms):
+        mask = (1 << 29) - 1
+        for zoom in zooms:
+            if self.spool is not None:
+                keys = sorted(key for key in self.entries if key >> 58 == zoom)
+            else:
+                i1 = bisect.bisect_left(self.keys, zoom << 58)
+                i2 = bisect.bisect_left(self.keys, (zoom + 1) << 58)
+                keys = self.keys[i1:i2]
+            for key in keys:
+                yield (key >> 29) & mask, key & mask, zoom
+
+    def commit(self):
+        if self.spool is not None:
+            self.spool.flush()
+
+    def close(self):
+        if self.spool is not None:
+            self.build_archive()
+        if self.map is not None:
+            for view in (self.keys, self.offsets, self.dates, self.lengths, self.view):
+                view.release()
+            try:
+                self.map.close()
+            except BufferError:
+                # tile buffers still in use, mapping closed when released
+                pass
+            self.map = None
+
+    def build_archive(self):
+        # tiles are copied from spool in key order, index follows tiles
+        keys = sorted(self.entries)
+        offsets = array.array('Q')
+        dates = array.array('q')
+        lengths = array.array('I')
+        filename = self.fullname + '.build'
+        with open(filename, 'wb') as f:
+            f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, 0, 0))
+            for key in keys:
+                offset, length, date = self.entries[key]
+                self.spool.seek(offset)
+                offsets.append(f.tell())
+                dates.append(-1 if date is None else date)
+                lengths.append(length)
+                f.write(self.spool.read(length))
+            f.write(b'\0' * (-f.tell() % 8))
+            index = f.tell()
+            array.array('Q', keys).tofile(f)
+            offsets.tofile(f)
+            dates.tofile(f)
+            lengths.tofile(f)
+            f.seek(0)
+            f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(keys), index))
+        self.spool.close()
+        os.remove(self.fullname + '.spool')
+        os.replace(filename, self.fullname)
+        self.spool = None
+        self.entries = dict()
+        self.open_archive()
 
 
 # persistence of database properties
@@ -1705,22 +2887,40 @@ class DatabaseProperties:
 # database factory
 
 
-def db_factory(db_name):
+# tiles are written with upserts (INSERT ... ON CONFLICT DO UPDATE)
+SQLITE_VERSION_MIN = (3, 24, 0)
+
+
+def db_factory(db_name, options=None, write=False):
+    # write is set for databases modified by the command
     db_format, tile_format, url_template = DatabaseProperties(db_name).get()
+    settings = None if options is None else options.database
 
     if db_format is None:
         error('tile database format is not declared. Use -describe to describe database.')
+    elif db_format in ('KAHELO', 'RMAPS', 'MBTILES') and sqlite3.sqlite_version_info < SQLITE_VERSION_MIN:
+        error('sqlite %s or later is required by sqlite databases, version found is %s' %
+              ('.'.join(str(n) for n in SQLITE_VERSION_MIN), sqlite3.sqlite_version))
     elif db_format == 'KAHELO':
-        return KaheloDatabase(db_name, tile_format, url_template)
+        db = KaheloDatabase(db_name, tile_format, url_template, settings, write)
     elif db_format == 'RMAPS':
-        return RmapsDatabase(db_name, tile_format, url_template)
+        db = RmapsDatabase(db_name, tile_format, url_template, settings, write)
+    elif db_format == 'MBTILES':
+        db = MbtilesDatabase(db_name, tile_format, url_template, settings, write)
     elif db_format == 'FOLDER':
         return FolderDatabase(db_name, tile_format, url_template)
     elif db_format == 'MAVERICK':
         return MaverickDatabase(db_name, tile_format, url_template)
+    elif db_format == 'ARCHIVE':
+        return ArchiveDatabase(db_name, tile_format, url_template)
     else:
         error('unknown tile database format')
 
+    # databases created by previous versions are upgraded when opened for writing
+    if db.duplicates and options is not None and options.verbosity > 0:
+        print('Database %s upgraded, %d duplicated tiles removed' % (db_name, db.duplicates))
+    return db
+
 
 # -- Traces ------------------------------------------------------------------
 
@@ -1735,6 +2935,26 @@ class TileCounters:
         self.deleted = 0
         self.missing = 0
         self.failure = 0
+        self.not_modified = 0
+
+
+class TileWriter:
+    # helper class, tiles are written to database by batches when committing
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+
+    def update(self, date, x, y, zoom, tile, validators=(None, None)):
+        self.rows.append((date, x, y, zoom, tile, validators))
+
+    def touch(self, date, x, y, zoom):
+        self.db.touch(date, x, y, zoom)
+
+    def commit(self):
+        if self.rows:
+            self.db.update_many(self.rows)
+            self.rows = []
+        self.db.commit()
 
 
 def tile_trace(options, x, y, zoom, index, size, msg, counters=None):
@@ -1751,6 +2971,20 @@ def tile_trace(options, x, y, zoom, index, size, msg, counters=None):
         tile_message(x, y, zoom, index, size, msg, counters)
 
 
+def progress_trace(options, index, count, size):
+    # trace of count tiles from index processed at once, same output as
+    # tile_trace with default verbosity but without a loop on tiles
+    if options.verbosity != 1 or count <= 0:
+        return
+    last = None
+    for pc in range(100 * index // size + 1, 100 * (index + count) // size + 1):
+        # first tile reaching pc percent
+        num = (pc * size + 99) // 100
+        if num != last:
+            print('Tiles %d%% (%d/%d)' % (100 * num // size, num, size))
+            last = num
+
+
 def tile_message(x, y, zoom, index, size, msg, counters=None):
     if counters is None:
         print('Tile (%d,%d,%d) %d/%d: %s' % (x, y, zoom, index+1, size, msg))
@@ -1880,6 +3114,21 @@ def do_describe(db_name, options):
     print('url_template', url_template)
 
 
+# -rebuild: compute again database summary ----------------------------------
+
+
+def do_rebuild(db_name, options):
+    db = db_factory(db_name, options, write=True)
+    if not isinstance(db, KaheloDatabase):
+        error('summary is available only with kahelo databases')
+    db.rebuild_summary()
+    summary = db.summary(range(MAXZOOM + 1))
+    display_report(options, ('Zoom levels', len(summary)),
+                            ('Tile rows', sum(len(rows) for rows in summary.values())),
+                            ('Tiles', sum(row[1] for rows in summary.values() for row in rows)))
+    db.close()
+
+
 # -count : number of tiles for source and zoom -------------------------------
 
 
@@ -1892,20 +3141,41 @@ def do_count(db_name, options):
     return size, inserted, expired, missing
 
 
+# existence of tiles is checked by batches
+EXISTS_BATCH = 1000
+
+
+def tiles_with_status(tiles, *dbs):
+    # iterate on tiles with their status (exists, date) in each database
+    tiles = iter(tiles)
+    while True:
+        batch = list(itertools.islice(tiles, EXISTS_BATCH))
+        if not batch:
+            break
+        statuses = [db.exists_many(batch) for db in dbs]
+        for tile in batch:
+            yield (tile,) + tuple(status[tile] for status in statuses)
+
+
 def count(db_name, options):
-    db = db_factory(db_name)
+    db = db_factory(db_name, options)
     tiles = tileset(options, db, db_filter=options.inside)
     return count_tileset(tiles, db, options)
 
 
-def count_tileset(tiles, db, options):
+def count_tileset(tiles, db, options, start=0):
+    # count from index start in sorted order, return the counts for these tiles
     n = tiles.size()
 
+    if options.verbosity < 2:
+        inserted, expired = count_tileset_fast(tiles, db, options, start, n)
+        return n - start, inserted, expired, n - start - inserted - expired
+
     inserted = 0
     expired = 0
 
-    for index, (x, y, zoom) in enumerate(tiles.sorted()):
-        exists, date = db.exists(x, y, zoom)
+    sorted_tiles = itertools.islice(tiles.sorted(), start, None)
+    for index, ((x, y, zoom), (exists, date)) in enumerate(tiles_with_status(sorted_tiles, db), start):
         if exists:
             if date is None or date > options.database.expiry_date:
                 inserted += 1
@@ -1917,93 +3187,627 @@ def count_tileset(tiles, db, options):
             msg = 'missing'
         tile_trace(options, x, y, zoom, index, n, msg)
 
-    return tiles.size(), inserted, expired, tiles.size() - inserted - expired
+    return n - start, inserted, expired, n - start - inserted - expired
+
+
+# minimal average number of tiles by run to count tile sets by runs
+RANGE_COUNT_MIN = 64
+
+
+def count_tileset_fast(tiles, db, options, start, n):
+    # count tiles without per tile requests, return numbers of up to date
+    # and expired tiles
+    expiry_date = options.database.expiry_date
+    counts = None
+    if start == 0 and isinstance(tiles, DatabaseTileSet) and tiles.db is db:
+        # tiles of the database, counted by the database if possible
+        counts = db.count_records(tiles.zooms, expiry_date)
+    if start == 0 and counts is None:
+        rectangles = tiles.rectangles()
+        if rectangles is None and isinstance(tiles, TileSet):
+            # long runs of tiles are counted as one column rectangles
+            runs = list(itertools.islice(tiles.runs(), n // RANGE_COUNT_MIN + 1))
+            if len(runs) <= n // RANGE_COUNT_MIN:
+                rectangles = [(zoom, x, y0, x, y1, y1 - y0 + 1) for zoom, x, y0, y1 in runs]
+        if rectangles is not None:
+            counts = count_rectangles(db, rectangles, expiry_date)
+    if counts is not None:
+        progress_trace(options, 0, n, n)
+        return counts
+
+    inserted = 0
+    expired = 0
+    sorted_tiles = itertools.islice(tiles.sorted(), start, None)
+    index = start
+    while True:
+        batch = list(itertools.islice(sorted_tiles, EXISTS_BATCH))
+        if not batch:
+            break
+        uptodate_, expired_ = db.count_many(batch, expiry_date)
+        inserted += uptodate_
+        expired += expired_
+        if options.verbosity == 1:
+            for x, y, zoom in batch:
+                tile_trace(options, x, y, zoom, index, n, 'counted')
+                index += 1
+    return inserted, expired
+
+
+def count_rectangles(db, rectangles, expiry_date):
+    # return None if the database does not count by rectangles
+    inserted = 0
+    expired = 0
+    for zoom, xmin, ymin, xmax, ymax, n in rectangles:
+        counts = db.count_range(zoom, xmin, ymin, xmax, ymax, expiry_date)
+        if counts is None:
+            return None
+        inserted += counts[0]
+        expired += counts[1]
+    return inserted, expired
 
 
 # -insert : download of tiles and insertion in database ----------------------
 
 
 def do_insert(db_name, options):
-    db = db_factory(db_name)
+    db = db_factory(db_name, options, write=True)
     tiles = tileset(options, db, db_filter=options.inside)
+    n = tiles.size()
+
+    # resume previous session if interrupted with the same tile set
+    journal = InsertJournal(db_name, tileset_definition(options, n))
+    start = journal.high_water_mark
+    if start > 0 and options.verbosity > 0:
+        print('Resuming session at tile %d/%d' % (start + 1, n))
 
     options_ = copy.copy(options)
     options_.verbosity = 0
-    size, inserted, expired, missing = count_tileset(tiles, db, options_)
+    size, inserted, expired, missing = count_tileset(tiles, db, options_, start)
 
-    n = tiles.size()
     counters = TileCounters()
     counters.to_be_inserted = size - inserted
+    counters.downloading = 0
+    pool = ConnectionPool(options.insert.pool_size, options.insert.timeout)
+    limiter = RateLimiter(options.insert.rate, options.insert.burst)
+    writer = TileWriter(db)
 
     try:
-        for index, (x, y, zoom) in enumerate(tiles.sorted()):
-            insert_tile(tiles, db, options, x, y, zoom, index, n, counters)
+        asyncio.run(insert_pipeline(db, writer, tiles, options, n, counters, pool, limiter, journal))
     finally:
         # final commit even if interrupted by user
-        db.commit()
+        writer.commit()
+        db.close()
+        pool.close()
+        if journal.high_water_mark < n:
+            journal.save()
+        else:
+            journal.remove()
         if options.verbosity >= 2:
             print('Commit.')
-        display_report(options, ('Tiles in set', n),
-                                ('Already present', counters.ignored),
-                                ('Inserted', counters.inserted),
-                                ('Missing', counters.missing))
+        entries = [('Tiles in set', n)]
+        if start > 0:
+            entries.append(('Previous session', start))
+        entries.extend([('Already present', counters.ignored),
+                        ('Inserted', counters.inserted),
+                        ('Not modified', counters.not_modified),
+                        ('Missing', counters.missing),
+                        ('Throttled', limiter.throttled),
+                        ('Connections', pool.opened),
+                        ('Reused', pool.reused),
+                        ('Max reuse', pool.max_reuse)])
+        display_report(options, *entries)
+
+
+def tileset_definition(options, size):
+    # string identifying tile set and insertion mode, used to resume sessions
+    return repr((options.track, options.tracks, options.contour, options.contours,
+                 options.disk, options.project, options.db_tiles, options.coord_tiles,
+                 options.zoom, getattr(options, 'zoom_limit', None), options.radius,
+                 options.inside, options.force_insert, size))
+
+
+class InsertJournal:
+    """
+    Progress of an insertion session, saved next to the database at each
+    commit and removed when all tiles have been processed. The high water mark
+    is the index, in sorted order, of the first tile not processed yet. Tiles
+    not found on the server are remembered and not requested again.
+    """
+    def __init__(self, db_name, definition):
+        norm_name = os.path.normpath(db_name)
+        self.filename = norm_name + '.journal'
+        self.section = 'insert_session'
+        self.warning = '; This file has been created by %s.\n' % APPNAME
+        self.definition = definition
+        self.high_water_mark = 0
+        self.not_found = set()
 
+        if os.path.isfile(self.filename):
+            parser = configparser.RawConfigParser()
+            try:
+                parser.read(self.filename)
+                if parser.get(self.section, 'tileset') == definition:
+                    self.high_water_mark = parser.getint(self.section, 'high_water_mark')
+                    for tile in parser.get(self.section, 'not_found').split():
+                        self.not_found.add(tuple(int(x) for x in tile.split(',')))
+            except Exception:
+                # unreadable journal, start a new session
+                self.high_water_mark = 0
+                self.not_found = set()
+
+    def save(self):
+        parser = configparser.RawConfigParser()
+        parser.add_section(self.section)
+        parser.set(self.section, 'tileset', self.definition)
+        parser.set(self.section, 'high_water_mark', str(self.high_water_mark))
+        parser.set(self.section, 'not_found', ' '.join('%d,%d,%d' % tile for tile in sorted(self.not_found)))
+        try:
+            # replace journal in one step to survive interruption
+            with open(self.filename + '.tmp', 'w') as f:
+                f.write(self.warning)
+                parser.write(f)
+            os.replace(self.filename + '.tmp', self.filename)
+        except Exception as e:
+            error('unable to write ' + self.filename + ' : ' + str(e))
+
+    def remove(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+# Insertion is run as a pipeline of stages connected by bounded queues: tileset
+# enumeration, check in database, download, transcoding and writing. Network
+# waits, image conversions and database writes overlap while the number of
+# tiles in progress is bounded by the depth of the queues whatever the size of
+# the tileset. The database is only accessed from the thread of the event
+# loop, downloads and conversions are run by a pool of worker threads. Tiles
+# are written and traced in tileset order.
+
+
+async def insert_pipeline(db, writer, tiles, options, n, counters, pool, limiter, journal):
+    loop = asyncio.get_running_loop()
+    workers = options.insert.workers
+    depth = options.insert.queue_depth
+    executor = ThreadPoolExecutor(max_workers=workers)
+    transcoder = transcoding_pool(options) or executor
+
+    to_check = asyncio.Queue(depth)
+    to_download = asyncio.Queue(depth)
+    to_transcode = asyncio.Queue(depth)
+    to_write = asyncio.Queue(depth)
+
+    # bound for tiles in progress including the ones waiting for their turn
+    # to be written
+    in_progress = asyncio.Semaphore(4 * depth)
+
+    start = journal.high_water_mark
+
+    async def enumeration_stage():
+        for index, (x, y, zoom) in itertools.islice(enumerate(tiles.sorted()), start, None):
+            await in_progress.acquire()
+            await to_check.put(InsertJob(x, y, zoom, index))
+        await to_check.put(None)
+
+    async def check_stage():
+        # jobs waiting in queue are checked together
+        done = False
+        while not done:
+            jobs = [await to_check.get()]
+            while not to_check.empty() and len(jobs) < EXISTS_BATCH:
+                jobs.append(to_check.get_nowait())
+            if jobs[-1] is None:
+                done = True
+                jobs.pop()
+            statuses = db.exists_many((job.x, job.y, job.zoom) for job in jobs)
+            for job in jobs:
+                check_tile(db, options, job, counters, journal, statuses[(job.x, job.y, job.zoom)])
+                if job.action == DOWNLOAD:
+                    await to_download.put(job)
+                else:
+                    await to_write.put(job)
+        for _ in range(workers):
+            await to_download.put(None)
+        await to_write.put(None)
+
+    async def download_stage():
+        while True:
+            job = await to_download.get()
+            if job is None:
+                break
+            await loop.run_in_executor(executor, download_job, options, db, pool, limiter, job)
+            await to_transcode.put(job)
+        await to_transcode.put(None)
+
+    async def transcode_stage():
+        tile_format = db.tile_format()
+        while True:
+            job = await to_transcode.get()
+            if job is None:
+                break
+            if (job.tile_buffer is not None and tile_format != 'SERVER' and
+                    tile_buffer_format(job.tile_buffer) != tile_format):
+                try:
+                    job.tile_buffer = await loop.run_in_executor(
+                        transcoder, transcode_tile, job.tile_buffer, tile_format,
+                        options.tiles.jpeg_quality)
+                except Exception as e:
+                    # traced when the tile is written
+                    job.messages.append('image conversion error open ' + str(e))
+                    job.tile_buffer = None
+            await to_write.put(job)
+        await to_write.put(None)
+
+    async def write_stage():
+        # jobs are written in enumeration order until the check stage and all
+        # the transcode workers have sent their end of stream marker
+        waiting = dict()
+        next_index = start
+        producers = workers + 1
+        while producers:
+            job = await to_write.get()
+            if job is None:
+                producers -= 1
+                continue
+            waiting[job.index] = job
+            while next_index in waiting:
+                insert_tile(writer, options, waiting.pop(next_index), n, counters, journal)
+                in_progress.release()
+                next_index += 1
+
+    tasks = [loop.create_task(enumeration_stage()),
+             loop.create_task(check_stage()),
+             loop.create_task(write_stage())]
+    tasks.extend(loop.create_task(download_stage()) for _ in range(workers))
+    tasks.extend(loop.create_task(transcode_stage()) for _ in range(workers))
 
-def insert_tile(tiles, db, options, x, y, zoom, index, n, counters):
-    exists_dst, date_dst = db.exists(x, y, zoom)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        executor.shutdown()
+        transcoder.shutdown()
+
+
+class InsertJob:
+    # helper class, tile going through the insertion pipeline
+    def __init__(self, x, y, zoom, index):
+        self.x = x
+        self.y = y
+        self.zoom = zoom
+        self.index = index
+        self.exists_dst = None
+        self.action = None
+        self.url = None
+        self.tile_buffer = None
+        self.validators = (None, None)
+        self.not_modified = False
+        self.not_found = False
+        self.messages = []
+
+
+# insert job actions
+IGNORE, SESSION_MAX, DOWNLOAD, NOT_FOUND = range(4)
+
+
+def check_tile(db, options, job, counters, journal, status_dst):
+    exists_dst, date_dst = status_dst
     exists_src, date_src = True, None
 
+    job.exists_dst = exists_dst
     if not should_insert(options, exists_src, date_src, exists_dst, date_dst):
-        counters.ignored += 1
-        tile_trace(options, x, y, zoom, index, n, 'already in database')
-    elif counters.inserted >= options.insert.session_max:
-        counters.missing += 1
+        job.action = IGNORE
+    elif (job.x, job.y, job.zoom) in journal.not_found:
+        job.action = NOT_FOUND
+    elif counters.inserted + counters.downloading >= options.insert.session_max:
+        # tiles being downloaded are counted to never exceed the session limit
+        job.action = SESSION_MAX
     else:
-        sleep(options.insert.request_delay)
+        job.action = DOWNLOAD
+        counters.downloading += 1
+        if exists_dst and not options.force_insert:
+            # expired tile, revalidated with a conditional request if possible
+            job.validators = db.validators(job.x, job.y, job.zoom)
 
-        for i in range(options.insert.number_of_attempts):
-            url = tile_url(options, db, x, y, zoom)
-            try:
-                # no proxy handling...
-                u = urlopen(url, timeout=options.insert.timeout)
-                tile_buffer = u.read()
-                u.close()
+
+def download_job(options, db, pool, limiter, job):
+    """
+    Download a tile. Run by the download workers, must not access the database.
+    Set the url, the tile buffer (None if not available) with its validators
+    and the list of messages to be traced when the tile is written. Tiles
+    already in database are requested only if modified when validators are
+    known.
+    """
+    etag, last_modified = job.validators
+    headers = dict()
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    for i in range(options.insert.number_of_attempts):
+        job.url = url = tile_url(options, db, job.x, job.y, job.zoom)
+        host = urlsplit(url).netloc
+        limiter.acquire(host)
+        try:
+            status, response_headers, tile_buffer = pool.get(url, headers)
+        except Exception as e:
+            job.messages.append('%s : Exception connection error %d - %s' % (url, i+1, e))
+            continue
+
+        if status == 200:
+            limiter.success(host)
+            job.tile_buffer = tile_buffer
+            job.validators = (response_headers.get('ETag'), response_headers.get('Last-Modified'))
+            return
+        elif status == 304:
+            limiter.success(host)
+            job.not_modified = True
+            return
+        elif status == 404:
+            job.not_found = True
+            job.messages.append('%s : not found' % url)
+            return
+        else:
+            if status in (429, 503):
+                limiter.throttle(host, response_headers.get('Retry-After'))
+            job.messages.append('%s : connection error %d - %d' % (url, i+1, status))
+
+
+class ConnectionPool:
+    """
+    Persistent http connections to tile servers. Idle connections are kept
+    per host (after expansion of url stripes) and reused by the download
+    workers, avoiding connection and TLS setup on each request. Proxies are
+    given by the environment (http_proxy, https_proxy and no_proxy): http
+    requests are sent to the proxy with absolute urls, https requests go
+    through a tunnel.
+    """
+    MAX_REDIRECTIONS = 5
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.proxies = dict()
+        for scheme, proxy_url in getproxies().items():
+            if scheme in ('http', 'https'):
+                self.proxies[scheme] = proxy_settings(proxy_url)
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+        self.opened = 0
+        self.reused = 0
+        self.max_reuse = 0
+
+    def get(self, url, headers=None):
+        # return status, headers and body of response, follow redirections
+        for _ in range(self.MAX_REDIRECTIONS + 1):
+            status, response_headers, body = self.request(url, headers)
+            if status in (301, 302, 303, 307, 308) and response_headers.get('Location'):
+                url = urljoin(url, response_headers.get('Location'))
+            else:
                 break
-            except HTTPError as e:
-                if e.code == 404:
-                    counters.missing += 1
-                    tile_trace(options, x, y, zoom, index, n, '%s : not found' % url)
-                    return
-                else:
-                    tile_trace(options, x, y, zoom, index, n, '%s : connection error %d - %d' % (url, i+1, e.code))
-            except Exception as e:
-                tile_trace(options, x, y, zoom, index, n, '%s : Exception connection error %d - %s' % (url, i+1, e))
+        return status, response_headers, body
+
+    def request(self, url, headers=None):
+        parts = urlsplit(url)
+        proxy = self.proxy(parts)
+        host = (parts.scheme, parts.netloc, proxy)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        headers = dict(headers or {})
+        headers['User-Agent'] = '%s/%s' % (APPNAME, VERSION)
+        if proxy is not None and parts.scheme == 'http':
+            path = url
+            headers.update(proxy[1])
+
+        conn = self.acquire(host)
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except Exception:
+            self.discard(conn)
+            if conn.requests == 0:
+                raise
+            # the server has closed an idle connection, retry with a new one
+            conn = self.acquire(host, new=True)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except Exception:
+                self.discard(conn)
+                raise
+
+        with self.lock:
+            if conn.requests > 0:
+                self.reused += 1
+            conn.requests += 1
+            self.max_reuse = max(self.max_reuse, conn.requests - 1)
+        if response.will_close:
+            self.discard(conn)
         else:
-            counters.missing += 1
-            return
+            self.release(host, conn)
 
-        if db.tile_format() == 'SERVER':
-            pass
+        return response.status, response.msg, body
+
+    def proxy(self, parts):
+        # return (address, headers) of the proxy for url parts, None if direct
+        proxy = self.proxies.get(parts.scheme)
+        if proxy is None or proxy_bypass(parts.hostname or ''):
+            return None
+        return proxy
+
+    def acquire(self, host, new=False):
+        with self.lock:
+            if self.idle[host] and not new:
+                return self.idle[host].pop()
+            self.opened += 1
+        scheme, netloc, proxy = host
+        if proxy is None:
+            address = netloc
         else:
-            try:
-                tile_image = create_image_from_blob(tile_buffer)
-                tile_buffer = create_blob_from_image(tile_image,
-                                                     db.tile_format(),
-                                                     options.tiles.jpeg_quality)
-            except Exception as e:
-                tile_trace(options, x, y, zoom, index, n, 'image conversion error open ' + str(e))
-                counters.missing += 1
+            address = proxy[0]
+        if scheme == 'https':
+            conn = http_client.HTTPSConnection(address, timeout=self.timeout)
+            if proxy is not None:
+                conn.set_tunnel(netloc, headers=dict(proxy[1]))
+        else:
+            conn = http_client.HTTPConnection(address, timeout=self.timeout)
+        conn.requests = 0
+        return conn
+
+    def release(self, host, conn):
+        with self.lock:
+            if len(self.idle[host]) < self.size:
+                self.idle[host].append(conn)
                 return
+        conn.close()
 
-        db.update(int(math.floor(time())), x, y, zoom, tile_buffer)
+    def discard(self, conn):
+        conn.close()
 
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+            self.idle.clear()
+
+
+def proxy_settings(proxy_url):
+    # return address of proxy and headers for proxy authentication, headers
+    # are given as a tuple to be part of the keys of idle connections
+    parts = urlsplit(proxy_url if '//' in proxy_url else '//' + proxy_url)
+    address = '%s:%d' % (parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+    headers = dict()
+    if parts.username:
+        credentials = '%s:%s' % (unquote(parts.username), unquote(parts.password or ''))
+        headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    return address, tuple(headers.items())
+
+
+class RateLimiter:
+    """
+    Token bucket per tile server host: requests are allowed at a sustained
+    rate with bursts. The rate of a host is halved when it answers with 429 or
+    503, waiting for the delay it requests if any, and recovers progressively
+    with successful requests. Without sustained rate, requests to the host are
+    suspended after 429 or 503 for the delay requested, or for a backoff delay
+    doubled on each refusal. Shared by the download workers.
+    """
+    # backoff delays in seconds without sustained rate
+    BACKOFF_MIN = 1.0
+    BACKOFF_MAX = 60.0
+
+    class Bucket:
+        # helper class
+        def __init__(self, tokens, rate, now):
+            self.tokens = tokens
+            self.rate = rate
+            self.last = now
+            self.blocked_until = now
+            self.backoff = 0
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = dict()
+        self.throttled = 0
+
+    def bucket(self, host, now):
+        # must be called with lock acquired
+        if host not in self.buckets:
+            self.buckets[host] = RateLimiter.Bucket(self.burst, self.rate, now)
+        bucket = self.buckets[host]
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.last) * bucket.rate)
+        bucket.last = now
+        return bucket
+
+    def acquire(self, host):
+        with self.lock:
+            now = monotonic()
+            bucket = self.bucket(host, now)
+            delay = bucket.blocked_until - now
+            if self.rate > 0:
+                # take a token even if not available yet and wait for it
+                bucket.tokens -= 1
+                delay = max(-bucket.tokens / bucket.rate, delay)
+        if delay > 0:
+            sleep(delay)
+
+    def throttle(self, host, retry_after=None):
+        try:
+            retry_after = float(retry_after)
+        except (TypeError, ValueError):
+            # missing or given as a date
+            retry_after = 0
+        with self.lock:
+            self.throttled += 1
+            now = monotonic()
+            bucket = self.bucket(host, now)
+            if self.rate > 0:
+                bucket.rate = max(bucket.rate / 2, self.rate / 100)
+                bucket.tokens = min(bucket.tokens, 0)
+            else:
+                bucket.backoff = min(max(2 * bucket.backoff, self.BACKOFF_MIN), self.BACKOFF_MAX)
+                retry_after = max(retry_after, bucket.backoff)
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+
+    def success(self, host):
+        with self.lock:
+            bucket = self.bucket(host, monotonic())
+            if self.rate > 0:
+                bucket.rate = min(self.rate, bucket.rate + self.rate / 20)
+            else:
+                bucket.backoff /= 2
+
+
+def insert_tile(writer, options, job, n, counters, journal):
+    x, y, zoom, index = job.x, job.y, job.zoom, job.index
+
+    # the high water mark stops at the first tile to be processed again
+    if journal.high_water_mark == index and (job.action != SESSION_MAX and
+                                             (job.action != DOWNLOAD or job.not_found or
+                                              job.not_modified or job.tile_buffer is not None)):
+        journal.high_water_mark += 1
+
+    if job.action == IGNORE:
+        counters.ignored += 1
+        tile_trace(options, x, y, zoom, index, n, 'already in database')
+        return
+    elif job.action == SESSION_MAX:
+        counters.missing += 1
+        return
+    elif job.action == NOT_FOUND:
+        counters.missing += 1
+        tile_trace(options, x, y, zoom, index, n, 'not found in previous session')
+        return
+
+    counters.downloading -= 1
+    for msg in job.messages:
+        tile_trace(options, x, y, zoom, index, n, msg)
+
+    if job.not_modified:
+        writer.touch(int(math.floor(time())), x, y, zoom)
+        counters.not_modified += 1
+        tile_trace(options, x, y, zoom, index, n, '%s : not modified' % job.url)
+    elif job.tile_buffer is None:
+        counters.missing += 1
+        if job.not_found:
+            journal.not_found.add((x, y, zoom))
+        return
+    else:
+        writer.update(int(math.floor(time())), x, y, zoom, job.tile_buffer, job.validators)
         counters.inserted += 1
-        msg = 'updated' if exists_dst else 'inserted'
-        tile_trace(options, x, y, zoom, index, n, '%s : %s' % (url, msg), counters)
-        if counters.inserted % options.database.commit_period == 0:
-            db.commit()
-            if options.verbosity >= 2:
-                print('Commit.')
+        msg = 'updated' if job.exists_dst else 'inserted'
+        tile_trace(options, x, y, zoom, index, n, '%s : %s' % (job.url, msg), counters)
+
+    if (counters.inserted + counters.not_modified) % options.database.commit_period == 0:
+        writer.commit()
+        journal.save()
+        if options.verbosity >= 2:
+            print('Commit.')
 
 
 def tile_url(options, db, x, y, zoom):
@@ -2032,73 +3836,202 @@ def do_import(db_name, options):
     if options.db_source is None:
         error('source database must be given')
 
-    db_arg = db_factory(db_name)
-    db_src = db_factory(options.db_source)
+    db_arg = db_factory(db_name, options, write=True)
+    db_src = db_factory(options.db_source, options)
     tiles = tileset(options, db_arg, db_filter=options.inside)
 
-    import_tiles(options, db_src, db_arg, tiles)
+    result = import_tiles(options, db_src, db_arg, tiles)
+    db_arg.close()
+    return result
 
 
 def import_tiles(options, db_src, db_dst, tiles):
+    # return numbers of tiles in set, already present, inserted and missing
     n = tiles.size()
     counters = TileCounters()
 
-    for index, (x, y, zoom) in enumerate(tiles.sorted()):
-        import_tile(tiles, db_dst, x, y, zoom, options, index, n, counters, db_src)
-    db_dst.commit()
+    if options.verbosity < 2 and import_tiles_sql(options, db_src, db_dst, tiles, n, counters):
+        display_report(options, ('Tiles in set', n),
+                                ('Already present', counters.ignored),
+                                ('Inserted', counters.inserted),
+                                ('Missing', counters.missing))
+        return n, counters.ignored, counters.inserted, counters.missing
+
+    # tiles are read and written by the current process in tileset order,
+    # conversions are run by the transcoding pool
+    pool = transcoding_pool(options)
+    window = 4 * transcoding_processes(options)
+    pending = collections.deque()
+    writer = TileWriter(db_dst)
+
+    try:
+        for index, ((x, y, zoom), status_src, status_dst) in enumerate(tiles_with_status(tiles.sorted(), db_src, db_dst)):
+            pending.append(prepare_import_tile(pool, db_dst, x, y, zoom, options, index, db_src,
+                                               status_src, status_dst))
+            while pending and (len(pending) > window or pending[0].done()):
+                import_tile(writer, options, pending.popleft(), n, counters)
+        while pending:
+            import_tile(writer, options, pending.popleft(), n, counters)
+    finally:
+        for job in pending:
+            job.cancel()
+        if pool:
+            pool.shutdown()
+    writer.commit()
 
     display_report(options, ('Tiles in set', n),
                             ('Already present', counters.ignored),
                             ('Inserted', counters.inserted),
                             ('Missing', counters.missing))
+    return n, counters.ignored, counters.inserted, counters.missing
+
+
+# Tiles are copied with a single request between sqlite databases when they
+# are not converted. Tiles of the tile set are loaded in a temporary table of
+# the destination database, the source database is attached and the insertion
+# strategy is given as a predicate on source (s) and destination (d) tiles.
+
+
+def import_tiles_sql(options, db_src, db_dst, tiles, n, counters):
+    # return False if tiles cannot be copied by a request, mbtiles databases
+    # are handled only as source as their metadata is updated tile by tile
+    sql_sources = (KaheloDatabase, RmapsDatabase, MbtilesDatabase)
+    sql_destinations = (KaheloDatabase, RmapsDatabase)
+    if (not isinstance(db_src, sql_sources) or not isinstance(db_dst, sql_destinations) or
+            options.Import.draw_tile_width or options.Import.draw_tile_limits or
+            db_src.tile_format() != db_dst.tile_format()):
+        return False
+
+    if options.force_insert:
+        # FORCE_MODE
+        predicate = '1'
+    else:
+        # UPDATE_MODE
+        predicate = ('d.rowid IS NULL OR ({dst_date} IS NOT NULL AND '
+                     '(({src_date} IS NULL AND {dst_date} <= %f) OR {src_date} > {dst_date}))' %
+                     options.database.expiry_date)
+
+    found, copied = db_dst.import_sql(db_src, tiles.sorted(), predicate, int(math.trunc(time())))
+
+    counters.inserted = copied
+    counters.ignored = found - copied
+    counters.missing = n - found
+    progress_trace(options, 0, n, n)
+    return True
+
+
+class ImportJob:
+    # helper class, tile waiting for its turn to be written in destination
+    def __init__(self, x, y, zoom, index, action):
+        self.x = x
+        self.y = y
+        self.zoom = zoom
+        self.index = index
+        self.action = action
+        self.exists_dst = None
+        self.date_src = None
+        self.future = None
+        self.tile = None
+
+    def done(self):
+        return self.future is None or self.future.done()
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+
+    def result(self):
+        # return converted tile, None if conversion failed
+        if self.future is None:
+            return self.tile
+        try:
+            return self.future.result()
+        except CustomException:
+            raise
+        except Exception:
+            return None
 
 
-def import_tile(tiles, db_dst, x, y, zoom, options, index, n, counters, db_src):
-    exists_dst, date_dst = db_dst.exists(x, y, zoom)
-    exists_src, date_src = db_src.exists(x, y, zoom)
+# import job actions
+MISSING_SRC, IGNORE_SRC, CONVERT = range(3)
+
+
+def prepare_import_tile(pool, db_dst, x, y, zoom, options, index, db_src, status_src, status_dst):
+    exists_src, date_src = status_src
+    exists_dst, date_dst = status_dst
 
     if not exists_src:
-        counters.missing += 1
-        tile_trace(options,x, y, zoom, index, n, 'missing in source')
-        return
+        return ImportJob(x, y, zoom, index, MISSING_SRC)
 
     if not should_insert(options, exists_src, date_src, exists_dst, date_dst):
-        counters.ignored += 1
-        tile_trace(options,x, y, zoom, index, n, 'source ignored')
-        return
+        return ImportJob(x, y, zoom, index, IGNORE_SRC)
+
+    job = ImportJob(x, y, zoom, index, CONVERT)
+    job.exists_dst = exists_dst
 
-    # retrieve from source, tile is a PIL image
-    exists_src, date_src, tile = db_src.retrieve(x, y, zoom)
+    # retrieve from source
+    exists_src, job.date_src, tile_buffer = db_src.retrieve_buffer(x, y, zoom)
 
     if exists_src is None:
-        counters.missing += 1
-        tile_trace(options, x, y, zoom, index, n, 'source unreadable')
-        return
+        # source unreadable
+        return job
+
+    # tile already in destination format, no conversion if nothing to draw
+    if (not options.Import.draw_tile_width and not options.Import.draw_tile_limits and
+            tile_buffer_format(tile_buffer) == db_dst.tile_format()):
+        job.tile = tile_buffer
+        return job
 
     # prepare drawing
-    if date_src is not None and date_src > options.database.expiry_date:
+    if job.date_src is not None and job.date_src > options.database.expiry_date:
         color = options.tiles.border_valid_color
     else:
         color = options.tiles.border_expired_color
-    tile = tile.convert('RGBA')
 
-    # draw tile width if requested
-    if options.Import.draw_tile_width:
-        tile = draw_tile_width(x, y, zoom, tile, color)
+    # convert to destination tile format drawing tile width and border if requested
+    args = (tile_buffer, x, y, zoom, color,
+            options.Import.draw_tile_width, options.Import.draw_tile_limits,
+            db_dst.tile_format(), options.tiles.jpeg_quality)
+    if pool is None:
+        try:
+            job.tile = transcode_import_tile(*args)
+        except CustomException:
+            raise
+        except Exception:
+            job.tile = None
+    else:
+        # buffers mapped from archive databases cannot be sent to processes
+        job.future = pool.submit(transcode_import_tile, bytes(tile_buffer), *args[1:])
 
-    # draw tile border if requested
-    if options.Import.draw_tile_limits:
-        tile = draw_alpha_border(tile, color)
+    return job
 
-    # convert to destination tile format
-    tile = create_blob_from_image(tile, db_dst.tile_format(), options.tiles.jpeg_quality)
 
-    db_dst.update(date_src, x, y, zoom, tile)
-    if index % options.database.commit_period == 0:
-        db_dst.commit()
+def import_tile(writer, options, job, n, counters):
+    x, y, zoom, index = job.x, job.y, job.zoom, job.index
+
+    if job.action == MISSING_SRC:
+        counters.missing += 1
+        tile_trace(options,x, y, zoom, index, n, 'missing in source')
+        return
 
+    if job.action == IGNORE_SRC:
+        counters.ignored += 1
+        tile_trace(options,x, y, zoom, index, n, 'source ignored')
+        return
+
+    tile = job.result()
+
+    if tile is None:
+        counters.missing += 1
+        tile_trace(options, x, y, zoom, index, n, 'source unreadable')
+        return
+
+    writer.update(job.date_src, x, y, zoom, tile)
     counters.inserted += 1
-    if exists_dst:
+    if counters.inserted % options.database.commit_period == 0:
+        writer.commit()
+
+    if job.exists_dst:
         tile_trace(options, x, y, zoom, index, n, 'updated')
     else:
         tile_trace(options, x, y, zoom, index, n, 'inserted')
@@ -2116,37 +4049,60 @@ def do_export(db_name, options):
     if options.db_dest is None:
         error('destination database must be given')
 
-    db_arg = db_factory(db_name)
-    db_dst = db_factory(options.db_dest)
+    db_arg = db_factory(db_name, options)
+    db_dst = db_factory(options.db_dest, options, write=True)
     tiles = tileset(options, db_arg, db_filter=options.inside)
 
-    import_tiles(options, db_arg, db_dst, tiles)
+    result = import_tiles(options, db_arg, db_dst, tiles)
+    db_dst.close()
+    return result
 
 
 # -delete: delete tiles from database ----------------------------------------
 
 
 def do_delete(db_name, options):
-    db = db_factory(db_name)
+    db = db_factory(db_name, options, write=True)
     tiles = tileset(options, db, db_filter=options.inside)
 
     size = tiles.size()
     counters = TileCounters()
 
-    for index, (x, y, zoom) in enumerate(tiles.sorted()):
-        delete_tile(tiles, db, x, y, zoom, options, index, size, counters)
+    # rectangles of tiles are deleted with one request when possible, tiles
+    # are deleted one by one when traced
+    rectangles = tiles.rectangles() if options.verbosity < 2 else None
+    if rectangles is None or not delete_rectangles(db, rectangles, options, size, counters):
+        for index, ((x, y, zoom), status) in enumerate(tiles_with_status(tiles.sorted(), db)):
+            delete_tile(tiles, db, x, y, zoom, options, index, size, counters, status)
 
     db.commit()
     db.pack()
+    db.close()
 
     display_report(options, ('Tiles in set', size),
                             ('Deleted', counters.deleted),
                             ('Failure', counters.failure),
                             ('Missing', counters.missing))
+    return size, counters.deleted, counters.failure, counters.missing
+
+
+def delete_rectangles(db, rectangles, options, size, counters):
+    # return False if the database does not delete by rectangles
+    index = 0
+    for zoom, xmin, ymin, xmax, ymax, n in rectangles:
+        deleted = db.delete_range(zoom, xmin, ymin, xmax, ymax)
+        if deleted is None:
+            return False
+        db.commit()
+        counters.deleted += deleted
+        counters.missing += n - deleted
+        progress_trace(options, index, n, size)
+        index += n
+    return True
 
 
-def delete_tile(tiles, db, x, y, zoom, options, index, size, counters):
-    exists, date = db.exists(x, y, zoom)
+def delete_tile(tiles, db, x, y, zoom, options, index, size, counters, status):
+    exists, date = status
 
     if not exists:
         counters.missing += 1
@@ -2167,7 +4123,7 @@ def delete_tile(tiles, db, x, y, zoom, options, index, size, counters):
 
 
 def do_makeview(db_name, options):
-    db = db_factory(db_name)
+    db = db_factory(db_name, options)
 
     _, source, zoom, radius = options_generate(options)
     if len(zoom) > 1:
@@ -2307,24 +4263,38 @@ def makeview_tile(tiles, db, mosaic, draw, tile_width, x0, y0, x, y, zoom, optio
 def do_server(db_name, options):
     global keep_running
     global db
-    db = db_factory(db_name)
+    global db_lock
+    db = db_factory(db_name, options)
+    db_lock = threading.Lock()
 
     server_address = ('127.0.0.1', options.server.port)
 
-    server = HTTPServer(server_address, TileServerHTTPRequestHandler)
+    server = TileServer(server_address, TileServerHTTPRequestHandler)
+    # connections are served by threads, end of server is checked periodically
+    server.timeout = 0.5
     print('tile server is running, ctrl-c to terminate...')
     keep_running = True
     while keep_running:
         server.handle_request()
+    server.server_close()
+
+
+class TileServer(ThreadingMixIn, HTTPServer):
+    # a thread per connection, connections are kept alive by clients
+    daemon_threads = True
 
 
 class TileServerHTTPRequestHandler(BaseHTTPRequestHandler):
+    # persistent connections, responses give their length
+    protocol_version = 'HTTP/1.1'
+
     def do_GET(self):
         global keep_running
         global db
         try:
             if 'SHUTDOWN' in self.path:
                 self.send_response(200)
+                self.send_header('Content-Length', '0')
                 self.end_headers()
                 keep_running = False
                 return
@@ -2335,16 +4305,19 @@ class TileServerHTTPRequestHandler(BaseHTTPRequestHandler):
 
             zoom, x, y = m.group(1,2,3)
             zoom, x, y = int(zoom), int(x), int(y)
-            exists, date, img = db.retrieve(x, y, zoom)
+            with db_lock:
+                exists, date, img = db.retrieve(x, y, zoom)
 
             if not exists:
                 raise IOError
 
+            tile_buffer = create_blob_from_image(img, 'JPG')
             self.send_response(200)
             self.send_header('Content-type','image/jpeg')
+            self.send_header('Content-Length', str(len(tile_buffer)))
             self.end_headers()
 
-            self.wfile.write(create_blob_from_image(img, 'JPG'))
+            self.wfile.write(tile_buffer)
             return
 
         except IOError:
@@ -2364,58 +4337,109 @@ def stop_server():
 # -stat : database statistics ------------------------------------------------
 
 
+class TileStatistics:
+    # helper class: sizes and extent of tiles per zoom level
+    def __init__(self):
+        maxzoomp1 = MAXZOOM + 1
+        self.count = [0] * maxzoomp1
+        self.width = [0] * maxzoomp1
+        self.number = [0] * maxzoomp1
+        self.total = [0] * maxzoomp1
+        self.size_min = [0] * maxzoomp1
+        self.size_max = [0] * maxzoomp1
+        self.xmin = [2 ** maxzoomp1] * maxzoomp1
+        self.ymin = [2 ** maxzoomp1] * maxzoomp1
+        self.xmax = [0] * maxzoomp1
+        self.ymax = [0] * maxzoomp1
+
+    def add_row(self, zoom, y, number, total, size_min, size_max, x_min, x_max):
+        # add number existing tiles of row y between x_min and x_max
+        if self.number[zoom] == 0 or size_min < self.size_min[zoom]:
+            self.size_min[zoom] = size_min
+        if size_max > self.size_max[zoom]:
+            self.size_max[zoom] = size_max
+        self.number[zoom] += number
+        self.total[zoom] += total
+        if x_min < self.xmin[zoom]: self.xmin[zoom] = x_min
+        if y < self.ymin[zoom]: self.ymin[zoom] = y
+        if x_max > self.xmax[zoom]: self.xmax[zoom] = x_max
+        if y > self.ymax[zoom]: self.ymax[zoom] = y
+
+
 def do_statistics(db_name, options):
-    db = db_factory(db_name)
+    db = db_factory(db_name, options)
     tiles = tileset(options, db, db_filter=options.inside)
     n = tiles.size()
 
+    stats = TileStatistics()
+    summary = None
+    if options.verbosity < 2 and isinstance(tiles, DatabaseTileSet) and tiles.db is db:
+        summary = db.summary(tiles.zooms)
+
+    if summary is not None:
+        # tiles of the database, statistics from the database summary
+        for zoom, rows in summary.items():
+            for y, count, total, size_min, size_max, x_min, x_max, oldest in rows:
+                # width of tiles depends only on latitude
+                stats.count[zoom] += count
+                stats.width[zoom] += count * tile_distance_km(x_min, y, x_min + 1, y, zoom)
+                stats.add_row(zoom, y, count, total, size_min, size_max, x_min, x_max)
+        progress_trace(options, 0, n, n)
+    elif options.verbosity < 2:
+        # sizes of tiles by batches, tiles are not read if possible
+        widths = dict()
+        sorted_tiles = iter(tiles.sorted())
+        index = 0
+        while True:
+            batch = list(itertools.islice(sorted_tiles, EXISTS_BATCH))
+            if not batch:
+                break
+            for x, y, zoom in batch:
+                if (zoom, y) not in widths:
+                    widths[(zoom, y)] = tile_distance_km(x, y, x + 1, y, zoom)
+                stats.count[zoom] += 1
+                stats.width[zoom] += widths[(zoom, y)]
+                tile_trace(options, x, y, zoom, index, n, 'counted')
+                index += 1
+            for row in db.size_summary(batch):
+                stats.add_row(*row)
+    else:
+        for index, (x, y, zoom) in enumerate(tiles.sorted()):
+            exists, date, buffer = db.retrieve_buffer(x, y, zoom)
+            stats.count[zoom] += 1
+            stats.width[zoom] += tile_distance_km(x, y, x + 1, y, zoom)
+            if exists:
+                stats.add_row(zoom, y, 1, len(buffer), len(buffer), len(buffer), x, x)
+                tile_trace(options, x, y, zoom, index, n, 'counted')
+            else:
+                pass
+
+    xmin, ymin, xmax, ymax = stats.xmin, stats.ymin, stats.xmax, stats.ymax
     maxzoomp1 = MAXZOOM + 1
-    sizes = []
-    size = [[] for _ in range(maxzoomp1)]
-    xmin = [2 ** maxzoomp1] * maxzoomp1
-    ymin = [2 ** maxzoomp1] * maxzoomp1
-    xmax = [0] * maxzoomp1
-    ymax = [0] * maxzoomp1
-    count = [0] * maxzoomp1
-    width = [0] * maxzoomp1
-
-    for index, (x, y, zoom) in enumerate(tiles.sorted()):
-        exists, date, buffer = db.retrieve_buffer(x, y, zoom)
-        count[zoom] += 1
-        width[zoom] += tile_distance_km(x, y, x + 1, y, zoom)
-        if exists:
-            sizes.append(len(buffer))
-            size[zoom].append(len(buffer))
-            if x < xmin[zoom]: xmin[zoom] = x
-            if y < ymin[zoom]: ymin[zoom] = y
-            if x > xmax[zoom]: xmax[zoom] = x
-            if y > ymax[zoom]: ymax[zoom] = y
-            tile_trace(options, x, y, zoom, index, n, 'counted')
-        else:
-            pass
 
-    display_report(options)
+    display_report(options, *db.settings())
     print('-' * 29)
     print('%4s %9s %7s %6s %6s %8s %12s (width in km, sizes in bytes)' % ('zoom', 'width', 'count', 'min', 'max', 'average', 'total'))
 
-    for zoom in [z for z,v in enumerate(size) if len(v) > 0]:
-        average_width = width[zoom] / count[zoom]
+    for zoom in [z for z,v in enumerate(stats.number) if v > 0]:
+        average_width = stats.width[zoom] / stats.count[zoom]
         sw = '{:,.2f}'.format(average_width)
-        slen  = decsep(len(size[zoom]))
-        smin  = decsep(min(size[zoom]))
-        smax  = decsep(max(size[zoom]))
-        smean = decsep(sum(size[zoom]) // len(size[zoom]))
-        stot  = decsep(sum(size[zoom]))
+        slen  = decsep(stats.number[zoom])
+        smin  = decsep(stats.size_min[zoom])
+        smax  = decsep(stats.size_max[zoom])
+        smean = decsep(stats.total[zoom] // stats.number[zoom])
+        stot  = decsep(stats.total[zoom])
         print('%4d %9s %7s %6s %6s %8s %12s' % (zoom, sw, slen, smin, smax, smean, stot))
 
-    if len(sizes) == 0:
+    number = sum(stats.number)
+    if number == 0:
         slen, smin, smax, smean, stot = [0] * 5
     else:
-        slen  = decsep(len(sizes))
-        smin  = decsep(min(sizes))
-        smax  = decsep(max(sizes))
-        smean = decsep(sum(sizes) // len(sizes))
-        stot  = decsep(sum(sizes))
+        slen  = decsep(number)
+        smin  = decsep(min(v for z, v in enumerate(stats.size_min) if stats.number[z] > 0))
+        smax  = decsep(max(stats.size_max))
+        smean = decsep(sum(stats.total) // number)
+        stot  = decsep(sum(stats.total))
     print('%4s %9s %7s %6s %6s %8s %12s' % ('all', '', slen, smin, smax, smean, stot))
     print('-' * 29)
 
@@ -2442,6 +4466,21 @@ def create_image_from_blob(blob):
         return Image.open(io.BytesIO(blob))
 
 
+def tile_buffer_format(tile_buffer):
+    # return format of image in buffer from its signature, None if not handled.
+    # PNG databases store palette images (PNG8), colour type in IHDR chunk is
+    # checked, other PNG images have to be converted.
+    if tile_buffer[:8] == b'\x89PNG\r\n\x1a\n':
+        if tile_buffer[12:16] == b'IHDR' and tile_buffer[25:26] == b'\x03':
+            return 'PNG'
+        else:
+            return None
+    elif tile_buffer[:3] == b'\xff\xd8\xff':
+        return 'JPG'
+    else:
+        return None
+
+
 def create_blob_from_image(img, format, jpeg_quality=85):
     # img is a PIL image
     # return buffer of image with requested format
@@ -2456,6 +4495,45 @@ def create_blob_from_image(img, format, jpeg_quality=85):
         return bytesIO.getvalue()
 
 
+# Conversions of tiles between formats are cpu bound and run by a pool of
+# processes. The following functions are run by the processes of the pool and
+# must not access databases.
+
+
+def transcoding_processes(options):
+    return options.tiles.processes or os.cpu_count() or 1
+
+
+def transcoding_pool(options):
+    # return the pool of processes converting tiles, None if tiles are converted
+    # in the current process
+    processes = transcoding_processes(options)
+    if processes == 1:
+        return None
+    else:
+        # processes are started when the first conversion is submitted, while
+        # the download threads are running, and must not be forked
+        return ProcessPoolExecutor(max_workers=processes,
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+
+def transcode_tile(tile_buffer, format, jpeg_quality=85):
+    # convert tile buffer to format
+    tile_image = create_image_from_blob(tile_buffer)
+    return create_blob_from_image(tile_image, format, jpeg_quality)
+
+
+def transcode_import_tile(tile_buffer, x, y, zoom, color, draw_width, draw_limits,
+                          format, jpeg_quality=85):
+    # convert tile buffer to format drawing tile width and limits if requested
+    tile = create_image_from_blob(tile_buffer).convert('RGBA')
+    if draw_width:
+        tile = draw_tile_width(x, y, zoom, tile, color)
+    if draw_limits:
+        tile = draw_alpha_border(tile, color)
+    return create_blob_from_image(tile, format, jpeg_quality)
+
+
 def save_image(img, target, format, jpeg_quality=85):
     # img is a PIL image
     # target is filename or StringIO/BytesIO
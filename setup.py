@@ -19,6 +19,7 @@ setup(
     packages = ['kahelo'],
     license = "MIT",
     install_requires = ['Pillow'],
+    extras_require = {'numpy': ['numpy']},
     entry_points='''
         [console_scripts]
         kahelo = kahelo.kahelo:kahelo